@@ -5,10 +5,19 @@ Datasource for remote Nagios plugin via NCPA
 import logging
 LOG = logging.getLogger('zen.NcpaPlugin')
 
-import json
-
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
+import collections
+import time
+
+from twisted.internet.defer import (
+    Deferred,
+    DeferredList,
+    DeferredSemaphore,
+    fail,
+    inlineCallbacks,
+    returnValue,
+    succeed
+    )
+from twisted.python.failure import Failure
 from zope.interface import implements
 
 from Products.ZenEvents import Event
@@ -24,9 +33,21 @@ from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     )
 
 from ZenPacks.daviswr.NCPA.dsplugins.Processes import send_to_debug
-from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+from ZenPacks.daviswr.NCPA.lib import ncpaClient, ncpaUtil
 from ZenPacks.daviswr.NCPA.lib.exceptions import NcpaError
 
+# Cycles a result reported while its plugin runs in the background can
+# be from when the datasource's maxStaleness isn't set
+STALE_CYCLES = 3
+
+
+def plugin_key(datasource):
+    """ Returns what makes a datasource's plugin check distinct """
+    return tuple(
+        datasource.params.get(param, '')
+        for param in ('ipAddress', 'port', 'pluginName', 'pluginArgs')
+        )
+
 
 class NcpaPluginDataSource(PythonDataSource):
     NCPA_PLUGIN = 'NcpaPlugin'
@@ -43,18 +64,38 @@ class NcpaPluginDataSource(PythonDataSource):
     token = '${dev/zNcpaToken}'
     pluginName = ''
     pluginArgs = ''
+    pluginTimeout = 0
+    staleWhileRevalidate = False
+    maxStaleness = 0
     _properties = PythonDataSource._properties + (
         {'id': 'ipAddress', 'type': 'string', 'mode': 'w'},
         {'id': 'port', 'type': 'int', 'mode': 'w'},
         {'id': 'pluginName', 'type': 'string', 'mode': 'w'},
         {'id': 'pluginArgs', 'type': 'string', 'mode': 'w'},
         {'id': 'token', 'type': 'string', 'mode': 'w'},
+        {'id': 'pluginTimeout', 'type': 'int', 'mode': 'w'},
+        {'id': 'staleWhileRevalidate', 'type': 'boolean', 'mode': 'w'},
+        {'id': 'maxStaleness', 'type': 'int', 'mode': 'w'},
         )
 
 
 class NcpaPluginDataSourcePlugin(PythonDataSourcePlugin):
+    @classmethod
+    def config_key(cls, datasource, context):
+        """ Return a tuple defining collection uniqueness. """
+        # All of a device's plugins on an agent are run together
+        return(
+            context.device().id,
+            datasource.getCycleTime(context),
+            datasource.talesEval(datasource.ipAddress, context),
+            datasource.talesEval(datasource.port, context),
+            'ncpa_plugins',
+            )
+
     @classmethod
     def params(cls, datasource, context):
+        max_staleness = (datasource.maxStaleness
+                         or STALE_CYCLES * datasource.getCycleTime(context))
         params = {
             'ipAddress': datasource.talesEval(datasource.ipAddress, context),
             'port': datasource.talesEval(datasource.port, context),
@@ -63,6 +104,11 @@ class NcpaPluginDataSourcePlugin(PythonDataSourcePlugin):
             'pluginArgs': datasource.talesEval(datasource.pluginArgs, context),
             'eventKey': datasource.talesEval(datasource.eventKey, context),
             'eventClass': datasource.talesEval(datasource.eventClass, context),
+            'pluginTimeout': datasource.pluginTimeout,
+            'staleWhileRevalidate': datasource.staleWhileRevalidate,
+            'maxStaleness': max_staleness,
+            'parallelism': context.zNcpaPluginParallelism,
+            'client': ncpaClient.client_settings(context),
             }
 
         return params
@@ -70,15 +116,142 @@ class NcpaPluginDataSourcePlugin(PythonDataSourcePlugin):
     @inlineCallbacks
     def collect(self, config):
         ip_addr = config.datasources[0].params.get('ipAddress', '')
-        token = config.datasources[0].params.get('token', '')
-        port = int(config.datasources[0].params.get('port', 5693))
-        plugin_name = config.datasources[0].params.get('pluginName', '')
-        plugin_args = config.datasources[0].params.get('pluginArgs', '')
-        err_str = ''
+        parallelism = int(config.datasources[0].params.get('parallelism', 1))
+        ncpaClient.configure(
+            ncpaUtil.agent_address(
+                ip_addr,
+                int(config.datasources[0].params.get('port', 5693))
+                ),
+            **config.datasources[0].params.get('client', {})
+            )
 
         if not ip_addr:
             err_str = 'No IP address or hostname'
-        elif not token:
+            LOG.error('%s: %s', config.id, err_str)
+            raise NcpaError(err_str)
+
+        # Identical checks are only run once per cycle
+        checks = collections.OrderedDict()
+        for datasource in config.datasources:
+            checks.setdefault(plugin_key(datasource), datasource)
+
+        LOG.debug(
+            '%s: Running %s plugins for %s datasources on NCPA client %s, '
+            '%s at a time',
+            config.id,
+            len(checks),
+            len(config.datasources),
+            ip_addr,
+            parallelism
+            )
+
+        if not hasattr(self, 'latest_results'):
+            # Plugin check -> (output, time completed) of the latest
+            self.latest_results = dict()
+            # Plugin check -> Deferreds waiting on its first result
+            self.refreshing = dict()
+            # Plugin check -> Failure of its latest background run
+            self.refresh_errors = dict()
+
+        # Small hosts shouldn't run every plugin at once, including
+        # checks still running in the background. Checks already waiting
+        # keep the limit they started with if zNcpaPluginParallelism
+        # changes.
+        parallelism = max(1, parallelism)
+        semaphore = getattr(self, 'semaphore', None)
+        if semaphore is None or semaphore.limit != parallelism:
+            self.semaphore = DeferredSemaphore(parallelism)
+
+        for key in set(self.latest_results) - set(checks):
+            del self.latest_results[key]
+        for key in set(self.refresh_errors) - set(checks):
+            del self.refresh_errors[key]
+        # A dropped check still running is left to finish and forgotten
+        for key in set(self.refreshing) - set(checks):
+            for waiter in self.refreshing.pop(key):
+                waiter.errback(Failure(NcpaError(
+                    'NCPA plugin {0} is no longer configured'.format(key[2])
+                    )))
+
+        results = yield DeferredList(
+            [self.check(config, datasource) for datasource in checks.values()],
+            consumeErrors=True
+            )
+        results = dict(zip(checks.keys(), results))
+
+        # (success, (output, time completed) or Failure) for each
+        # datasource, in order
+        returnValue([
+            results[plugin_key(datasource)]
+            for datasource in config.datasources
+            ])
+
+    def check(self, config, datasource):
+        """
+        Returns a Deferred firing with the output of a datasource's plugin
+        check and when it completed. With staleWhileRevalidate, that's
+        the latest completed check while another runs in the background,
+        or the failure of the latest if it failed.
+        """
+        if not datasource.params.get('staleWhileRevalidate', False):
+            d = self.semaphore.run(self.run_plugin, config, datasource)
+            d.addCallback(lambda output: (output, time.time()))
+            return d
+
+        key = plugin_key(datasource)
+        latest = self.latest_results.get(key)
+        waiter = Deferred() if latest is None else None
+
+        if key in self.refreshing:
+            if waiter is not None:
+                self.refreshing[key].append(waiter)
+        else:
+            self.refreshing[key] = [waiter] if waiter is not None else []
+            d = self.semaphore.run(self.run_plugin, config, datasource)
+            d.addBoth(self.refreshed, config, key)
+
+        if waiter is not None:
+            return waiter
+        # Reported like a check that failed in the foreground would be
+        error = self.refresh_errors.get(key)
+        return fail(error) if error is not None else succeed(latest)
+
+    def refreshed(self, result, config, key):
+        """ Keeps a background check's output, passes it to waiters """
+        waiters = self.refreshing.pop(key, None)
+        if waiters is None:
+            # No longer configured
+            return
+        elif isinstance(result, Failure):
+            LOG.debug(
+                '%s: NCPA plugin %s refresh failed: %s',
+                config.id,
+                key[2],
+                result.value
+                )
+            self.refresh_errors[key] = result
+        else:
+            result = (result, time.time())
+            self.latest_results[key] = result
+            self.refresh_errors.pop(key, None)
+
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    @inlineCallbacks
+    def run_plugin(self, config, datasource):
+        """ Runs a datasource's plugin, returns the NCPA API output """
+        ip_addr = datasource.params.get('ipAddress', '')
+        token = datasource.params.get('token', '')
+        port = int(datasource.params.get('port', 5693))
+        plugin_name = datasource.params.get('pluginName', '')
+        plugin_args = datasource.params.get('pluginArgs', '')
+        err_str = ''
+
+        if not token:
             err_str = 'zNcpaToken not set'
         elif not plugin_name:
             err_str = 'No NCPA plugin specified'
@@ -87,8 +260,6 @@ class NcpaPluginDataSourcePlugin(PythonDataSourcePlugin):
             LOG.error('%s: %s', config.id, err_str)
             raise NcpaError(err_str)
 
-        LOG.debug('%s: Collecting from NCPA client %s', config.id, ip_addr)
-
         url = ncpaUtil.build_url(
             host=ip_addr,
             port=port,
@@ -103,8 +274,22 @@ class NcpaPluginDataSourcePlugin(PythonDataSourcePlugin):
             url.replace(token, '')
             )
 
-        response = yield getPage(url, method='GET')
-        output = json.loads(response)
+        request = ncpaClient.fetch_json(url)
+        timeout = int(datasource.params.get('pluginTimeout', 0) or 0)
+        if (timeout <= 0
+                and datasource.params.get('staleWhileRevalidate', False)):
+            # Background checks can't hold their parallelism slot forever
+            timeout = int(getattr(datasource, 'cycletime', 0) or 0)
+        if timeout > 0:
+            request = ncpaClient.with_timeout(
+                request,
+                timeout,
+                'NCPA plugin {0} timed out after {1} seconds'.format(
+                    plugin_name,
+                    timeout
+                    )
+                )
+        output = yield request
 
         LOG.debug('%s: NCPA API output:\n%s', config.id, str(output))
         # This will raise an exception if necessary
@@ -112,26 +297,61 @@ class NcpaPluginDataSourcePlugin(PythonDataSourcePlugin):
         returnValue(output)
 
     def onSuccess(self, results, config):
-        plugin_name = config.datasources[0].params.get('pluginName', '')
-        event_key = config.datasources[0].params.get('eventKey', 'NcpaPlugin')
-        event_class = config.datasources[0].params.get(
-            'eventClass',
-            Status_Nagios
-            )
         data = self.new_data()
+        # Each distinct check's output is parsed once
+        parsed = dict()
+        # Thresholds and limits are only kept where datapoints use them
+        limit_keys = set(
+            plugin_key(datasource)
+            for datasource in config.datasources
+            for datapoint in datasource.points
+            if datapoint.id.rsplit('_', 1)[-1] in ncpaUtil.perfdata_limits
+            )
 
-        returncode = int(results.get('returncode', -1))
-        stdout = results.get('stdout', '')
+        for datasource, (success, result) in zip(config.datasources, results):
+            if not success:
+                self.plugin_error(data, config, datasource, result)
+                continue
+
+            key = plugin_key(datasource)
+            if key not in parsed:
+                output, completed = result
+                state, long_text, perf = ncpaUtil.split_plugin_output(
+                    output.get('stdout', '')
+                    )
+                values = ncpaUtil.perfdata_values(perf, key in limit_keys)
+                values['returncode'] = int(output.get('returncode', -1))
+                values['result_age'] = max(0.0, time.time() - completed)
+                parsed[key] = (
+                    state,
+                    ncpaUtil.nagios_severity(state),
+                    values,
+                    long_text,
+                    )
+            self.plugin_success(data, config, datasource, *parsed[key])
 
-        state, severity, values = ncpaUtil.parse_nagios(stdout)
-        values['returncode'] = returncode
+        return data
+
+    def onError(self, error, config):
+        data = self.new_data()
 
         for datasource in config.datasources:
-            comp = datasource.component
-            for datapoint in datasource.points:
-                if datapoint.id in values:
-                    value = values[datapoint.id]
-                    data['values'][comp][datapoint.dpName] = (value, 'N')
+            self.plugin_error(data, config, datasource, error)
+
+        return data
+
+    def plugin_success(self, data, config, datasource, state, severity,
+                       values, long_text=''):
+        """ Adds a plugin's values and status event to data """
+        plugin_name = datasource.params.get('pluginName', '')
+        event_key = datasource.params.get('eventKey', 'NcpaPlugin')
+        event_class = datasource.params.get('eventClass', Status_Nagios)
+
+        comp = datasource.component
+        for datapoint in datasource.points:
+            if datapoint.id in values:
+                value = values[datapoint.id]
+                data['values'][comp][datapoint.dpName] = (value, 'N')
 
         data['events'].append({
             'device': config.id,
@@ -140,21 +360,33 @@ class NcpaPluginDataSourcePlugin(PythonDataSourcePlugin):
             'eventClass': event_class,
             'component': plugin_name,
             'summary': state,
+            'message': long_text or state,
             })
 
-        return data
-
-    def onError(self, error, config):
-        plugin_name = config.datasources[0].params.get('pluginName', '')
-        event_key = config.datasources[0].params.get('eventKey', 'NcpaPlugin')
-        event_class = config.datasources[0].params.get(
-            'eventClass',
-            Status_Nagios
-            )
-        data = self.new_data()
-
-        msg = '{0} NCPA plugin execution error: {1}'.format(
+        if datasource.params.get('staleWhileRevalidate', False):
+            age = values['result_age']
+            max_staleness = int(datasource.params.get('maxStaleness', 0) or 0)
+            stale = max_staleness > 0 and age > max_staleness
+            data['events'].append({
+                'device': config.id,
+                'severity': Event.Error if stale else Event.Clear,
+                'eventKey': '{0}Staleness'.format(event_key),
+                'eventClass': event_class,
+                'component': plugin_name,
+                'summary': 'NCPA plugin result {0:.0f} seconds old'.format(
+                    age
+                    ),
+                })
+
+    def plugin_error(self, data, config, datasource, error):
+        """ Adds a plugin's error event to data """
+        plugin_name = datasource.params.get('pluginName', '')
+        event_key = datasource.params.get('eventKey', 'NcpaPlugin')
+        event_class = datasource.params.get('eventClass', Status_Nagios)
+
+        msg = '{0} NCPA plugin {1} execution error: {2}'.format(
             config.id,
+            plugin_name,
             error.value
             )
         if send_to_debug(error):
@@ -171,8 +403,6 @@ class NcpaPluginDataSourcePlugin(PythonDataSourcePlugin):
             'summary': 'NCPA plugin execution error: {0}'.format(error.value),
             })
 
-        return data
-
 
 class INcpaPluginDataSourceInfo(IRRDDataSourceInfo):
     cycletime = schema.TextLine(title=_t(u'Cycle Time (seconds)'))
@@ -190,6 +420,18 @@ class INcpaPluginDataSourceInfo(IRRDDataSourceInfo):
         group=_t('NCPA Plugin')
         )
     token = schema.TextLine(title=_t(u'Token'), group=_t('NCPA Plugin'))
+    pluginTimeout = schema.Int(
+        title=_t(u'Plugin Timeout (seconds, 0 for a cycle in background)'),
+        group=_t('NCPA Plugin')
+        )
+    staleWhileRevalidate = schema.Bool(
+        title=_t(u'Report Latest Result While Plugin Runs'),
+        group=_t('NCPA Plugin')
+        )
+    maxStaleness = schema.Int(
+        title=_t(u'Maximum Result Age (seconds, 0 for 3 cycles)'),
+        group=_t('NCPA Plugin')
+        )
 
 
 class NcpaPluginDataSourceInfo(RRDDataSourceInfo):
@@ -200,6 +442,9 @@ class NcpaPluginDataSourceInfo(RRDDataSourceInfo):
     pluginName = ProxyProperty('pluginName')
     pluginArgs = ProxyProperty('pluginArgs')
     token = ProxyProperty('token')
+    pluginTimeout = ProxyProperty('pluginTimeout')
+    staleWhileRevalidate = ProxyProperty('staleWhileRevalidate')
+    maxStaleness = ProxyProperty('maxStaleness')
 
     @property
     def testable(self):
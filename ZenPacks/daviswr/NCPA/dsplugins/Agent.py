@@ -5,10 +5,10 @@ Monitors device metrics using the Nagios Cross-Platform Agent API
 import logging
 LOG = logging.getLogger('zen.NCPA')
 
-import json
+import collections
+import time
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
 
 from Products.ZenEvents import Event
 from Products.ZenEvents.ZenEventClasses import Status_Nagios
@@ -17,13 +17,330 @@ from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     PythonDataSourcePlugin
     )
 
-from ZenPacks.daviswr.NCPA.dsplugins.Processes import send_to_debug
-from ZenPacks.daviswr.NCPA.lib import ncpaUtil
-from ZenPacks.daviswr.NCPA.lib.exceptions import NcpaError
+from ZenPacks.daviswr.NCPA.dsplugins.Processes import (
+    match_cache_counters,
+    send_to_debug
+    )
+from ZenPacks.daviswr.NCPA.lib import (
+    ncpaClient,
+    ncpaModeler,
+    ncpaSnapshot,
+    ncpaUtil
+    )
+from ZenPacks.daviswr.NCPA.lib.exceptions import (
+    NcpaError,
+    NcpaNodeDoesNotExistError
+    )
+from ZenPacks.daviswr.NCPA.lib.ncpaProcess import (
+    ProcessTable,
+    strip_parameters
+    )
+from ZenPacks.daviswr.NCPA.modeler.plugins.daviswr.ncpa import (
+    AgentMap,
+    HardDiskMap,
+    InterfaceMap,
+    ServiceMap
+    )
 from ZenPacks.daviswr.NCPA.modeler.plugins.daviswr.ncpa.FileSystemMap import (
+    FileSystemMap,
     guess_block_size
     )
 
+# Time counters reported for each CPU by api/cpu
+CPU_COUNTERS = ('idle', 'system', 'user')
+
+# NCPA API nodes needed by device-level datapoints, by datapoint prefix.
+# Nodes under avg/ are requested with aggregate=avg
+DEVICE_NODES = (
+    # Transfer counters kept by the collector
+    ('bytes_', ()),
+    ('cpu_percent', ('avg/cpu', 'avg/cpu/percent')),
+    ('cpu_', ('avg/cpu',)),
+    # Process class match cache counters kept by Processes
+    ('match_cache_', ()),
+    ('mem_', ('processes',)),
+    ('memory_', ('memory/virtual',)),
+    ('proc_', ('processes',)),
+    ('processes', ('processes',)),
+    # Request queue counters kept by the collector
+    ('request_', ()),
+    ('swap_', ('memory/swap',)),
+    ('sysUpTime', ('system',)),
+    # TopProcesses template
+    ('top_', ('processes',)),
+    ('users', ('user',)),
+    )
+
+# Device-level datasource of the busiest processes
+TOP_SOURCE = 'top'
+
+# NCPA API node needed by component-level datasources
+COMPONENT_NODES = {
+    'cpu': 'cpu',
+    'disk': 'disk/logical',
+    'diskstats': 'disk/physical',
+    'intf': 'interface',
+    'services': 'services',
+    }
+
+# Modeler plugin of each component-level datasource's components
+REMODEL_PLUGINS = {
+    'disk': FileSystemMap,
+    'diskstats': HardDiskMap.HardDiskMap,
+    'intf': InterfaceMap.InterfaceMap,
+    'services': ServiceMap.ServiceMap,
+    }
+
+# Components remodeled at most this often across the collector
+MAX_REMODELS = 30
+REMODEL_WINDOW = 60
+
+# Times of recent remodels across the collector
+_remodels = collections.deque()
+
+# Datasources whose components can be requested individually
+KEYED_SOURCES = ('disk', 'diskstats', 'intf')
+
+# Nodes whose items can be requested individually
+KEYED_NODES = tuple(COMPONENT_NODES[src] for src in KEYED_SOURCES)
+
+# Query parameters for nodes beyond the defaults
+NODE_PARAMS = {
+    'processes': {'aggregate': 'avg'},
+    }
+
+# More top-level nodes than this are requested with the whole tree
+MAX_ROOT_NODES = 3
+
+# Nodes that can be decoded item by item as they arrive
+STREAMED_NODES = ('disk/logical', 'processes', 'services')
+
+
+def cpu_percent(previous, current):
+    """
+    Calculates CPU utilization from two samples of api/cpu time counters
+
+    @parameter previous: idle, system and user counter lists, last cycle
+    @type previous: tuple
+    @parameter current: idle, system and user counter lists, this cycle
+    @type current: tuple
+    @return: utilization percentage per CPU, None where unknown
+    @rtype: list
+    """
+    percents = list()
+    if len(previous[0]) != len(current[0]):
+        return percents
+
+    for idx in range(0, len(current[0])):
+        deltas = [float(now[idx]) - float(then[idx])
+                  for then, now in zip(previous, current)]
+        idle = deltas[0]
+        total = sum(deltas)
+        # Counters went backwards, probably an agent restart
+        if min(deltas) < 0 or total <= 0:
+            percents.append(None)
+        else:
+            percents.append(100.0 * (total - idle) / total)
+
+    return percents
+
+
+def process_summary(table, top=0):
+    """
+    Summarizes api/processes for device-level datapoints
+
+    @parameter table: processes from api/processes
+    @type table: ProcessTable
+    @parameter top: number of busiest processes to include
+    @type top: int
+    @return: process sums, and top processes by CPU and RSS
+    @rtype: dict
+    """
+    summary = table.totals()
+    if top > 0:
+        summary['top'] = {
+            'cpu': table.top('cpu_percent', top),
+            'rss': table.top('mem_rss', top),
+            }
+    return summary
+
+
+def top_process_name(cmd, exe=''):
+    """ Returns the executable name of a process """
+    name = strip_parameters(cmd, exe)
+    return name.replace('\\', '/').split('/')[-1] or cmd
+
+
+def component_key(context):
+    """ Returns the item name NCPA uses for a modeled component """
+    # Stored by FileSystemMap, components modeled before it may not have it
+    key = getattr(context, 'ncpaKey', '')
+    if key:
+        return key
+
+    mount = getattr(context, 'mount', '')
+    if mount:
+        # Reverse FileSystemMap's path clean up
+        return (mount.replace('/', '|') if mount.startswith('/')
+                else mount + '|')
+
+    return getattr(context, 'interfaceName', '') or context.title
+
+
+def required_nodes(datasources, cpu_from_counters=False, whole=()):
+    """
+    Determines the NCPA API nodes needed by datasources' datapoints
+
+    @parameter datasources: datasource configs for a device
+    @type datasources: list
+    @parameter cpu_from_counters: CPU percentages calculated locally
+    @type cpu_from_counters: bool
+    @parameter whole: component-level datasources whose node is needed
+        in full, with or without components
+    @type whole: list
+    @return: API node paths
+    @rtype: set
+    """
+    nodes = set(COMPONENT_NODES[src] for src in whole)
+    for datasource in datasources:
+        src = datasource.datasource
+        points = [datapoint.id for datapoint in datasource.points]
+        if src in COMPONENT_NODES:
+            node = COMPONENT_NODES[src]
+            key = datasource.params.get('key', '')
+            if key and src in KEYED_SOURCES and src not in whole:
+                node = '{0}/{1}'.format(node, key)
+            nodes.add(node)
+            if 'cpu' == src and 'percent' in points:
+                nodes.add('cpu/percent')
+        else:
+            for point in points:
+                for prefix, point_nodes in DEVICE_NODES:
+                    if point.startswith(prefix):
+                        nodes.update(point_nodes)
+                        break
+
+    if cpu_from_counters:
+        nodes.discard('cpu/percent')
+        nodes.discard('avg/cpu/percent')
+
+    return nodes
+
+
+def narrow_nodes(nodes):
+    """
+    Reduces NCPA API nodes to fewer requests. Sibling nodes are requested
+    by their parent and many top-level nodes by the root node, ''.
+    """
+    nodes = set(nodes)
+    while True:
+        siblings = collections.defaultdict(set)
+        for node in nodes:
+            if '/' in node and node not in ncpaUtil.uncovered_nodes:
+                siblings[node.rsplit('/', 1)[0]].add(node)
+
+        collapsed = False
+        for parent, children in siblings.items():
+            if len(children) > 1:
+                nodes -= children
+                nodes.add(parent)
+                collapsed = True
+
+        if not collapsed:
+            break
+
+    top_level = set(
+        node.split('/')[0] for node in nodes if ncpaUtil.covers('', node)
+        )
+    if len(top_level) > MAX_ROOT_NODES:
+        nodes.add('')
+
+    return set(
+        node for node in nodes
+        if not any(ncpaUtil.covers(other, node) for other in nodes)
+        )
+
+
+def remodel_sources(context):
+    """
+    Returns the component-level datasources whose components are modeled
+    by the device's NCPA modeler plugins
+    """
+    enabled = set(getattr(context, 'zCollectorPlugins', ()) or ())
+    if ncpaModeler.unified(context):
+        enabled.update(
+            plugin.name()
+            for plugin in AgentMap.AgentMap().enabled_plugins(context)
+            )
+    return sorted(
+        src for src, plugin in REMODEL_PLUGINS.iteritems()
+        if plugin().name() in enabled
+        )
+
+
+def component_ids(datamaps):
+    """ Returns the IDs of the components in modeler plugin datamaps """
+    if not isinstance(datamaps, list):
+        datamaps = [datamaps] if datamaps is not None else []
+    return set(
+        om.id
+        for datamap in datamaps
+        for om in getattr(datamap, 'maps', [])
+        if getattr(om, 'id', None)
+        )
+
+
+def remodel_allowed(now):
+    """ Whether the collector-wide remodel limit allows another one """
+    while _remodels and now - _remodels[0] > REMODEL_WINDOW:
+        _remodels.popleft()
+    if len(_remodels) >= MAX_REMODELS:
+        return False
+    _remodels.append(now)
+    return True
+
+
+def node_response(output, node):
+    """ Returns an NCPA API node from the output as the API returns it """
+    value = output
+    for name in node.split('/'):
+        value = value.get(name) if isinstance(value, dict) else None
+    return {node.split('/')[-1]: value}
+
+
+def device_params(config):
+    """
+    Returns the params of a config's device-level datasource, which are
+    the only ones carrying device-wide settings
+    """
+    for datasource in config.datasources:
+        if datasource.datasource not in COMPONENT_NODES:
+            return datasource.params
+    return dict()
+
+
+class ModeledDevice(object):
+    """ Stands in for the device a modeler plugin processes results for """
+
+    def __init__(self, device_id, properties):
+        self.id = device_id
+        self.__dict__.update(properties)
+
+
+def graft_node(output, node, response):
+    """ Places an NCPA API node's response at its path in the output """
+    if not node:
+        # Move everything out from under the 'root' key
+        output.update(response.get('root', response))
+        return
+
+    target = output
+    for name in node.split('/')[:-1]:
+        # Responses may be shared with other requests, so copy, not modify
+        target[name] = dict(target.get(name, dict()))
+        target = target[name]
+    target.update(response)
+
 
 class Agent(PythonDataSourcePlugin):
     """ NCPA storage device data source plugin """
@@ -40,16 +357,54 @@ class Agent(PythonDataSourcePlugin):
     @classmethod
     def params(cls, datasource, context):
         """ Return params dictionary needed for this plugin. """
-        return {
+        params = {
             'token': context.zNcpaToken,
             'port': context.zNcpaPort,
+            'cpu_from_counters': context.zNcpaCpuPercentFromCounters,
+            'stream': context.zNcpaStreamLargeResponses,
+            'snapshot': context.zNcpaSnapshotMaxAge,
             }
 
+        # Only needed once per device, not for every component
+        if datasource.id not in COMPONENT_NODES:
+            params.update({
+                'remodel': context.zNcpaRemodelInterval,
+                'client': ncpaClient.client_settings(context),
+                })
+            if context.zNcpaRemodelInterval > 0:
+                params['remodel_sources'] = remodel_sources(context)
+                params['model_properties'] = dict(
+                    (prop, getattr(context, prop, None))
+                    for plugin in REMODEL_PLUGINS.values()
+                    for prop in plugin.model_properties()
+                    )
+
+        if datasource.id in KEYED_SOURCES:
+            params['key'] = component_key(context)
+        elif TOP_SOURCE == datasource.id:
+            params['top'] = context.zNcpaTopProcesses
+
+        return params
+
     @inlineCallbacks
     def collect(self, config):
         ip_addr = config.manageIp or config.id
         token = config.datasources[0].params.get('token', '')
         port = int(config.datasources[0].params.get('port', 5693))
+        cpu_from_counters = config.datasources[0].params.get(
+            'cpu_from_counters',
+            False
+            )
+        stream = config.datasources[0].params.get('stream', False)
+        top = max(
+            [int(datasource.params.get('top', 0))
+             for datasource in config.datasources] + [0]
+            )
+        settings = device_params(config)
+        ncpaClient.configure(
+            ncpaUtil.agent_address(ip_addr, port),
+            **settings.get('client', {})
+            )
 
         if not ip_addr or not token:
             err_str = ('No IP address or hostname' if not ip_addr
@@ -59,78 +414,210 @@ class Agent(PythonDataSourcePlugin):
 
         LOG.debug('%s: Collecting from NCPA client %s', config.id, ip_addr)
 
-        root_url = ncpaUtil.build_url(host=ip_addr, port=port, token=token)
+        # Parents of keyed nodes that didn't exist, requested whole since
+        if not hasattr(self, 'unkeyed_nodes'):
+            self.unkeyed_nodes = set()
 
-        cpu_avg_url = ncpaUtil.build_url(
-            host=ip_addr,
-            port=port,
-            token=token,
-            endpoint='cpu',
-            params={'aggregate': 'avg'}
-            )
+        # Components being added or removed only show in whole nodes
+        remodeling = list()
+        if int(settings.get('remodel', 0) or 0) > 0:
+            remodeling = settings.get('remodel_sources', [])
 
-        # CPU percentage endpoint is returned as empty list by parent endpoints
-        cpu_pct_url = ncpaUtil.build_url(
-            host=ip_addr,
-            port=port,
-            token=token,
-            endpoint='cpu/percent',
+        nodes = set(
+            narrow_nodes(required_nodes(
+                config.datasources,
+                cpu_from_counters,
+                remodeling
+                ))
+            or ['system']
             )
+        nodes = narrow_nodes(set(
+            node.rsplit('/', 1)[0]
+            if node.rsplit('/', 1)[0] in self.unkeyed_nodes else node
+            for node in nodes
+            ))
+        # Parents are grafted into the output before their children
+        nodes = sorted(nodes, key=lambda node: (node.count('/'), node))
+        LOG.debug('%s: Requesting NCPA nodes %s', config.id, str(nodes))
+        # Only nodes requested whole show components being added or removed
+        self.requested_nodes = nodes
 
-        cpu_avg_pct_url = ncpaUtil.build_url(
-            host=ip_addr,
-            port=port,
-            token=token,
-            endpoint='cpu/percent',
-            params={'aggregate': 'avg'}
+        output = dict()
+        responses = yield self.request_nodes(
+            config, ip_addr, port, token, nodes, stream, top
             )
+        retry = list()
+        for node, response in zip(nodes, responses):
+            try:
+                # This will raise an exception if necessary
+                ncpaUtil.error_check(response)
+            except NcpaNodeDoesNotExistError:
+                parent = node.rsplit('/', 1)[0]
+                if parent in KEYED_NODES:
+                    # Modeled key doesn't match the agent's
+                    LOG.warn(
+                        '%s: NCPA node %s does not exist, requesting %s',
+                        config.id,
+                        node,
+                        parent
+                        )
+                    self.unkeyed_nodes.add(parent)
+                    retry.append(parent)
+                else:
+                    # Such as api/memory/swap with swap disabled
+                    LOG.debug(
+                        '%s: NCPA node %s does not exist',
+                        config.id,
+                        node
+                        )
+                continue
+            except NcpaError, err:
+                LOG.error('%s: %s', config.id, err)
+                raise
+            graft_node(output, node, response)
 
-        # Processes endpoint is returned as empty list by root endpoint
-        proc_url = ncpaUtil.build_url(
-            host=ip_addr,
-            port=port,
-            token=token,
-            endpoint='processes',
-            params={'aggregate': 'avg'}
-            )
+        if retry:
+            self.requested_nodes = sorted(
+                set(nodes) | set(retry),
+                key=lambda node: (node.count('/'), node)
+                )
+            responses = yield self.request_nodes(
+                config, ip_addr, port, token, retry, stream, top
+                )
+            for node, response in zip(retry, responses):
+                try:
+                    ncpaUtil.error_check(response)
+                except NcpaNodeDoesNotExistError:
+                    LOG.debug(
+                        '%s: NCPA node %s does not exist',
+                        config.id,
+                        node
+                        )
+                    continue
+                except NcpaError, err:
+                    LOG.error('%s: %s', config.id, err)
+                    raise
+                graft_node(output, node, response)
 
-        # Services endpoint is returned as empty list by root endpoint
-        srv_url = ncpaUtil.build_url(
-            host=ip_addr,
-            port=port,
-            token=token,
-            endpoint='services',
-            )
+        # Streamed processes are already summed
+        if isinstance(output.get('processes'), list):
+            table = ProcessTable()
+            for item in output['processes']:
+                table.add(item)
+            output['processes'] = process_summary(table, top)
 
-        response = yield getPage(root_url, method='GET')
-        output = json.loads(response)
-        # Move everything out from under the 'root' key
-        output = output.get('root', output)
+        max_age = int(config.datasources[0].params.get('snapshot', 0) or 0)
+        if max_age > 0:
+            self.save_snapshot(config, nodes, output, max_age)
 
-        response = yield getPage(cpu_avg_url, method='GET')
-        # Should give us avg/cpu
-        output['avg'] = json.loads(response)
+        LOG.debug('%s: NCPA API output:\n%s', config.id, str(output))
 
-        response = yield getPage(cpu_pct_url, method='GET')
-        if 'cpu' not in output:
-            output['cpu'] = dict()
-        output['cpu'].update(json.loads(response))
+        if cpu_from_counters:
+            self.derive_cpu_percent(config, output)
 
-        response = yield getPage(cpu_avg_pct_url, method='GET')
-        if 'cpu' not in output['avg']:
-            output['avg']['cpu'] = dict()
-        output['avg']['cpu'].update(json.loads(response))
+        returnValue(output)
 
-        response = yield getPage(proc_url, method='GET')
-        output.update(json.loads(response))
+    def request_nodes(self, config, ip_addr, port, token, nodes, stream,
+                      top=0):
+        """ Returns a Deferred firing with the responses for NCPA nodes """
+        requests = list()
+        for node in nodes:
+            endpoint = node
+            params = dict(NODE_PARAMS.get(node, {}))
+            if node.startswith('avg/'):
+                endpoint = node[len('avg/'):]
+                params['aggregate'] = 'avg'
+            url = ncpaUtil.build_url(
+                host=ip_addr,
+                port=port,
+                token=token,
+                endpoint=endpoint,
+                params=params
+                )
+            if stream and node in STREAMED_NODES:
+                requests.append(self.stream_node(url, node, top))
+            else:
+                requests.append(ncpaClient.fetch_json(url))
+        return ncpaClient.gather(requests)
 
-        response = yield getPage(srv_url, method='GET')
-        output.update(json.loads(response))
+    @inlineCallbacks
+    def stream_node(self, url, node, top=0):
+        """ Decodes a large NCPA API node item by item as it arrives """
+        name = node.split('/')[-1]
+        table = None
+        if 'processes' == node:
+            # Only the sums are kept, not the entries
+            table = ProcessTable()
+            consume = table.add
+        else:
+            items = dict()
 
-        LOG.debug('%s: NCPA API output:\n%s', config.id, str(output))
-        # This will raise an exception if necessary
-        ncpaUtil.error_check(output, config.id, LOG)
-        returnValue(output)
+            def consume(item):
+                """ Adds a (name, value) pair of the node's object """
+                items.update([item])
+
+        response = yield ncpaClient.fetch_items(url, name, consume)
+        # Probably an error, handled like any other response
+        if response is not None:
+            returnValue(response)
+
+        if table is not None:
+            items = process_summary(table, top)
+        returnValue({name: items})
+
+    def save_snapshot(self, config, nodes, output, max_age):
+        """
+        Shares the collected nodes with modeler plugins, often enough
+        that the snapshot is never older than max_age seconds
+        """
+        now = time.time()
+        if now - getattr(self, 'snapshot_saved', 0) < max_age / 2.0:
+            return
+        # Still being written
+        saving = getattr(self, 'snapshot_saving', None)
+        if saving is not None and not saving.called:
+            return
+        self.snapshot_saved = now
+        self.snapshot_saving = ncpaSnapshot.save(config.id, nodes, output)
+
+    def derive_cpu_percent(self, config, output):
+        """ Adds CPU percentages calculated from api/cpu time counters """
+        cpu_node = output.get('cpu', dict())
+        avg_node = output.get('avg', dict()).get('cpu', dict())
+        current = tuple(
+            cpu_node.get(counter, [[]])[0] for counter in CPU_COUNTERS
+            )
+        current_avg = tuple(
+            avg_node.get(counter, [[]])[0] for counter in CPU_COUNTERS
+            )
+
+        # Previous sample is kept between cycles to calculate deltas
+        previous, previous_avg = getattr(
+            self,
+            'previous_cpu_times',
+            (None, None)
+            )
+        self.previous_cpu_times = (current, current_avg)
+
+        if previous is None:
+            LOG.debug(
+                '%s: First CPU time sample, no percentage yet',
+                config.id
+                )
+            return
+
+        # Responses may be shared with other requests, so copy, not modify
+        if 'cpu' in output:
+            output['cpu'] = dict(
+                cpu_node,
+                percent=[cpu_percent(previous, current), '%']
+                )
+        if 'cpu' in output.get('avg', dict()):
+            output['avg'] = dict(output['avg'])
+            output['avg']['cpu'] = dict(
+                avg_node,
+                percent=[cpu_percent(previous_avg, current_avg), '%']
+                )
 
     def onSuccess(self, results, config):
         data = self.new_data()
@@ -144,6 +631,7 @@ class Agent(PythonDataSourcePlugin):
             'processes': dict(),
             'services': dict(),
             'sysUpTime': {None: dict()},
+            'top': {None: dict()},
             }
 
         for node_name in results:
@@ -157,22 +645,30 @@ class Agent(PythonDataSourcePlugin):
                 subnode = node['cpu']
                 stats[src][comp].update({
                     'cpu_idle': int(subnode['idle'][0][0]),
-                    'cpu_percent': float(subnode['percent'][0][0]),
                     'cpu_system': int(subnode['system'][0][0]),
                     'cpu_user': int(subnode['user'][0][0]),
                     })
+                # Not available on the first cycle calculating from counters
+                percent = subnode.get('percent')
+                percent = percent[0] if percent else []
+                if percent and percent[0] is not None:
+                    stats[src][comp]['cpu_percent'] = float(percent[0])
             # api/cpu - CPU components
             elif 'cpu' == node_name:
                 LOG.debug('%s: Processing api/cpu', config.id)
                 src = 'cpu'
+                percent = node.get('percent')
+                percent = percent[0] if percent else []
                 for item_idx in range(0, len(node['idle'][0])):
                     comp = prepId(str(item_idx))
                     stats[src][comp] = {
                         'idle': int(node['idle'][0][item_idx]),
-                        'percent': float(node['percent'][0][item_idx]),
                         'system': int(node['system'][0][item_idx]),
                         'user': int(node['user'][0][item_idx]),
                         }
+                    if (item_idx < len(percent)
+                            and percent[item_idx] is not None):
+                        stats[src][comp]['percent'] = float(percent[item_idx])
             # api/disk
             elif 'disk' == node_name:
                 src = node_name
@@ -323,30 +819,18 @@ class Agent(PythonDataSourcePlugin):
             # api/processes
             elif 'processes' == node_name:
                 LOG.debug('%s: Processing api/processes', config.id)
-                # Device-level metrics
-                stats[src][comp]['mem_rss'] = 0
-                stats[src][comp]['mem_vms'] = 0
-                stats[src][comp]['proc_cpu'] = 0.0
-                stats[src][comp]['proc_mem'] = 0.0
-                stats[src][comp]['processes'] = len(node)
-                # processes node is a list, rather than a dict
-                for item in node:
-                    stats[src][comp]['mem_rss'] += ncpaUtil.get_unit_value(
-                        item['mem_rss'][0],
-                        item['mem_rss'][1],
-                        )
-                    stats[src][comp]['mem_vms'] += ncpaUtil.get_unit_value(
-                        item['mem_vms'][0],
-                        item['mem_vms'][1],
+                # Device-level metrics, summed by collect
+                node = dict(node)
+                top = node.pop('top', None)
+                stats[src][comp].update(node)
+                if top:
+                    data['events'].append(
+                        self.top_event(config, top['cpu'], top['rss'])
                         )
-                    mem_pct = item.get('mem_percent', [0.0, ''])[0]
-                    stats[src][comp]['proc_mem'] += mem_pct
-                    if item.get('name', '') == 'System Idle Process':
-                        # CPU will always read 100% if System Idle is included
-                        stats[src][comp]['processes'] -= 1
-                    else:
-                        cpu_pct = item.get('cpu_percent', [0.0, ''])[0]
-                        stats[src][comp]['proc_cpu'] += cpu_pct
+                    if top['cpu']:
+                        stats['top'][None]['top_cpu'] = top['cpu'][0][2]
+                    if top['rss']:
+                        stats['top'][None]['top_rss'] = top['rss'][0][2]
 
             # api/services - NcpaService components
             elif 'services' == node_name:
@@ -371,6 +855,32 @@ class Agent(PythonDataSourcePlugin):
                 LOG.debug('%s: Processing api/user', config.id)
                 stats[src][comp]['users'] = int(node['count'][0])
 
+        # Bytes received from the agent, by every datasource so far
+        stats['ncpa'][None].update(ncpaClient.transfer_counters(
+            config.manageIp or config.id,
+            int(config.datasources[0].params.get('port', 5693))
+            ))
+
+        # Time this device's requests waited in the collector's queue
+        counters = ncpaClient.request_counters(
+            config.manageIp or config.id,
+            int(config.datasources[0].params.get('port', 5693))
+            )
+        previous = getattr(self, 'previous_request_counters', None)
+        self.previous_request_counters = counters
+        stats['ncpa'][None]['request_queue'] = counters['queued']
+        if previous:
+            requests = counters['requests'] - previous['requests']
+            if requests > 0:
+                wait_time = counters['wait_time'] - previous['wait_time']
+                stats['ncpa'][None]['request_wait'] = (
+                    1000.0 * wait_time / requests
+                    )
+
+        # How often Processes found a process class match already cached
+        if config.id in match_cache_counters:
+            stats['ncpa'][None].update(match_cache_counters[config.id])
+
         # Report the metrics gathered
         for datasource in config.datasources:
             LOG.debug(
@@ -381,13 +891,15 @@ class Agent(PythonDataSourcePlugin):
                 )
             if datasource.datasource in stats:
                 src = datasource.datasource
-                comp = (None if src in ['ncpa', 'sysUpTime']
+                comp = (None if src in ['ncpa', 'sysUpTime', TOP_SOURCE]
                         else datasource.component)
                 for datapoint in datasource.points:
                     if comp in stats[src] and datapoint.id in stats[src][comp]:
                         value = stats[src][comp][datapoint.id]
                         data['values'][comp][datapoint.dpName] = (value, 'N')
 
+        data['maps'].extend(self.topology_maps(config, results, stats))
+
         # Send clear
         data['events'].append({
             'device': config.id,
@@ -399,6 +911,139 @@ class Agent(PythonDataSourcePlugin):
 
         return data
 
+    def topology_maps(self, config, results, stats):
+        """
+        Returns datamaps from the modeler plugins of components added or
+        removed since the device was modeled. Each plugin is run at most
+        every zNcpaRemodelInterval seconds per device. A change held back
+        by the collector-wide limit is acted on in a later cycle.
+        """
+        params = device_params(config)
+        interval = int(params.get('remodel', 0) or 0)
+        if interval <= 0:
+            return []
+
+        # Last remodel check time by datasource, and the items and
+        # components the last check found nothing to remodel between
+        if not hasattr(self, 'remodeled'):
+            self.remodeled = dict()
+            self.settled = dict()
+
+        modeled = collections.defaultdict(set)
+        for datasource in config.datasources:
+            modeled[datasource.datasource].add(datasource.component)
+
+        maps = list()
+        now = time.time()
+        for src in params.get('remodel_sources', []):
+            if now - self.remodeled.get(src, 0) < interval:
+                continue
+
+            node = COMPONENT_NODES[src]
+            if not any(node == requested or ncpaUtil.covers(requested, node)
+                       for requested in getattr(self, 'requested_nodes', [])):
+                continue
+
+            # Such as a node that doesn't exist on this agent
+            response = node_response(results, node)
+            if not isinstance(response.values()[0], dict):
+                continue
+
+            # Items the plugin ignores are never modeled, only it can
+            # tell whether they're what's different
+            keys = frozenset(stats[src])
+            if (keys == modeled[src]
+                    or (keys, modeled[src]) == self.settled.get(src)):
+                continue
+
+            plugin = REMODEL_PLUGINS[src]()
+            device = ModeledDevice(
+                config.id,
+                params.get('model_properties', {})
+                )
+            try:
+                datamaps = plugin.process(device, response, LOG)
+            except Exception:
+                LOG.exception('%s: %s failed', config.id, plugin.name())
+                self.remodeled[src] = now
+                continue
+
+            ids = component_ids(datamaps)
+            added = ids - modeled[src]
+            removed = modeled[src] - ids
+            if not added and not removed:
+                self.remodeled[src] = now
+                self.settled[src] = (keys, frozenset(modeled[src]))
+                continue
+
+            # Only real changes count toward the collector-wide limit
+            if not remodel_allowed(now):
+                LOG.debug(
+                    '%s: %s remodel postponed by rate limit',
+                    config.id,
+                    plugin.name()
+                    )
+                continue
+
+            self.remodeled[src] = now
+
+            LOG.info(
+                '%s: Remodeling with %s, added %s, removed %s',
+                config.id,
+                plugin.name(),
+                ', '.join(sorted(added)) or 'none',
+                ', '.join(sorted(removed)) or 'none'
+                )
+            # zenmodeler's next results apply even if they're the same
+            # as the ones it last applied
+            ncpaModeler.forget_fingerprints(config.id, plugin.name())
+            if isinstance(datamaps, list):
+                maps.extend(datamaps)
+            elif datamaps is not None:
+                maps.append(datamaps)
+
+        return maps
+
+    def top_event(self, config, top_cpu, top_rss):
+        """ Returns an event summarizing the busiest processes """
+        summary = list()
+        message = list()
+        if top_cpu:
+            cmd, pid, value, exe = top_cpu[0]
+            summary.append('CPU {0} {1:.1f}%'.format(
+                top_process_name(cmd, exe),
+                value
+                ))
+            message.append('By CPU:')
+            message.extend(
+                '  {0:>7.1f}%  {1:>7}  {2}'.format(value, pid, cmd[:200])
+                for cmd, pid, value, exe in top_cpu
+                )
+        if top_rss:
+            cmd, pid, value, exe = top_rss[0]
+            summary.append('RSS {0} {1:.1f} MiB'.format(
+                top_process_name(cmd, exe),
+                value / 1024.0**2
+                ))
+            message.append('By RSS:')
+            message.extend(
+                '  {0:>9.1f} MiB  {1:>7}  {2}'.format(
+                    value / 1024.0**2,
+                    pid,
+                    cmd[:200]
+                    )
+                for cmd, pid, value, exe in top_rss
+                )
+
+        return {
+            'device': config.id,
+            'severity': Event.Info,
+            'eventKey': 'NcpaTopProcesses',
+            'eventClass': '/Perf',
+            'summary': 'Top processes: {0}'.format(', '.join(summary)),
+            'message': '\n'.join(message),
+            }
+
     def onError(self, error, config):
         data = self.new_data()
 
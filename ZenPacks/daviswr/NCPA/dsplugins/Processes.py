@@ -21,12 +21,14 @@ CPU utilization, total RSS and the number of processes that match the
 import logging
 LOG = logging.getLogger('zen.NCPA.processes')
 
+import array
 import collections
-import json
+import itertools
+import sre_constants
+import sre_parse
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.error import ConnectionLost
-from twisted.web.client import getPage
 try:
     from twisted.web._newclient import ResponseNeverReceived
 except ImportError:
@@ -39,67 +41,31 @@ from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     PythonDataSourcePlugin
     )
 
-from ZenPacks.daviswr.NCPA.lib import ncpaUtil
-from ZenPacks.daviswr.NCPA.lib.exceptions import NcpaError
+from ZenPacks.daviswr.NCPA.lib import ncpaClient, ncpaUtil
+from ZenPacks.daviswr.NCPA.lib.exceptions import (
+    NcpaCircuitOpenError,
+    NcpaError,
+    NcpaIncorrectCredentialsError
+    )
+from ZenPacks.daviswr.NCPA.lib.ncpaProcess import (
+    FIELDS,
+    ProcessTable,
+    strip_parameters
+    )
 
 COUNT_DATAPOINT = 'count'
 
+# More process filters than this and all processes are requested at once
+MAX_PROCESS_FILTERS = 10
 
-def _extractProcessMetrics(proc):
-    """
-    Process the process entry and return back the standard info.
-
-    @parameter proc: process dictionary from api/processes
-    @type proc: dict
-    @return: pid, rss, cpu, cmdAndArgs (ie full process name)
-    @rtype: tuple
-    """
-    try:
-        pid = proc['pid']
-        rss = ncpaUtil.get_unit_value(proc['mem_rss'][0], proc['mem_rss'][1])
-        cpu = proc['cpu_percent'][0]
-        cmdAndArgs = proc['cmd']
-        if not cmdAndArgs:
-            cmdAndArgs = proc['exe']
-        if 'Unknown' == cmdAndArgs or not cmdAndArgs:
-            cmdAndArgs = proc['name']
-
-        # ----------------------------------------------------------
-        # WARNING! Do not modify this debug line at all!
-        # The process class interactive testing UI depends on it!
-        # (yeah, yeah... technical debt... we know)
-        # ----------------------------------------------------------
-        LOG.debug("line '%s' -> pid=%s rss=%s cpu=%s cmdAndArgs=%s",
-                  str(proc), pid, rss, cpu, cmdAndArgs)
-        # ----------------------------------------------------------
-
-        # NCPA returns current CPU percent rathe than time
-        # so it can be graphed and mapped to cpu_pct directly
-        return int(pid), int(rss), float(cpu), cmdAndArgs
-    except:
-        LOG.warn("Unable to parse entry '%s'", str(proc))
-
-
-def process_metrics(processes):
-    """
-    Extracts desired metrics from process list returned by the NCPA API
-
-    @parameter processes: contents of api/processes
-    @type processes: list
-    @return: desired process metrics
-    @rtype: list
-    """
-    metrics = list()
-    for proc in processes:
-        pid, rss, cpu, processText = _extractProcessMetrics(proc)
-        metrics.append({
-            'pid': pid,
-            'mem': rss,
-            'cpu': cpu,
-            'processText': processText,
-        })
+# Command lines of processes matched by their executable or name instead,
+# such as kernel threads, requested alongside filtered ones
+NO_COMMAND_LINE = '^(Unknown)?$'
 
-    return metrics
+# Device ID -> cumulative process class match cache hits and misses
+match_cache_counters = collections.defaultdict(
+    lambda: {'match_cache_hits': 0, 'match_cache_misses': 0}
+    )
 
 
 def send_to_debug(error):
@@ -116,9 +82,274 @@ def send_to_debug(error):
             return True
     except AttributeError:
         pass
+    # The agent was reported unreachable when the circuit opened
+    if isinstance(error.value, NcpaCircuitOpenError):
+        return True
     return False
 
 
+def required_literal(regex):
+    """
+    Returns the longest run of literal text every match of a regex must
+    contain, or None if there isn't one that can be relied on
+
+    @parameter regex: process class include regex
+    @type regex: str
+    @return: literal text or None
+    @rtype: str
+    """
+    try:
+        parsed = sre_parse.parse(regex or '')
+    except (sre_constants.error, TypeError):
+        return None
+
+    flags = getattr(parsed.pattern, 'flags', 0)
+    if flags & (sre_constants.SRE_FLAG_IGNORECASE
+                | sre_constants.SRE_FLAG_VERBOSE):
+        return None
+
+    # Top-level items are all required unless there's an alternation
+    literal = ''
+    run = list()
+    for op, av in list(parsed) + [(None, None)]:
+        if sre_constants.BRANCH == op:
+            return None
+        if sre_constants.LITERAL == op and av < 128:
+            run.append(chr(av))
+            continue
+        if len(run) > len(literal):
+            literal = ''.join(run)
+        run = list()
+
+    return literal or None
+
+
+def process_filters(datasources):
+    """
+    Determines literal text to have NCPA filter processes' command lines
+    by, such that every process a datasource could match has one
+
+    @parameter datasources: process datasource configs
+    @type datasources: list
+    @return: literal text, or None if processes can't be filtered
+    @rtype: list
+    """
+    literals = set()
+    for datasource in datasources:
+        literal = required_literal(datasource.params.get('includeRegex'))
+        # Executables matched when ignoring parameters aren't filtered on
+        if not literal or datasource.params.get('ignoreParameters'):
+            return None
+        literals.add(literal)
+
+    if len(literals) > MAX_PROCESS_FILTERS:
+        return None
+    return sorted(literals)
+
+
+def matcher_entries(classes):
+    """
+    Builds a matcher for each process class, once rather than for every
+    process
+
+    @parameter classes: (match params, target) in matching order, where
+        params are a process class's includeRegex and so on
+    @type classes: list
+    @return: (required literal or None, matcher, target, ignoreParameters)
+    @rtype: list
+    """
+    entries = list()
+    for params, target in classes:
+        # Assume we're on at least 4.2.5 due to ZPL
+        matcher = OSProcessDataMatcher(
+            includeRegex=params.get('includeRegex'),
+            excludeRegex=params.get('excludeRegex'),
+            replaceRegex=params.get('replaceRegex'),
+            replacement=params.get('replacement'),
+            primaryUrlPath=params.get('primaryUrlPath'),
+            generatedId=params.get('generatedId')
+            )
+        entries.append((
+            required_literal(params.get('includeRegex')),
+            matcher,
+            target,
+            bool(params.get('ignoreParameters', False)),
+            ))
+    return entries
+
+
+def first_match(entries, processText, exe=''):
+    """
+    Returns the position of the first matcher entry matching a process,
+    or -1 if none do
+
+    @parameter entries: built by matcher_entries
+    @type entries: list
+    @parameter processText: process command and arguments
+    @type processText: str
+    @parameter exe: process executable, matched if ignoring parameters
+    @type exe: str
+    @rtype: int
+    """
+    stripped = None
+    for idx, (literal, matcher, target, ignore) in enumerate(entries):
+        text = processText
+        if ignore:
+            if stripped is None:
+                stripped = strip_parameters(processText, exe)
+            text = stripped
+        if literal and literal not in text:
+            continue
+        if matcher.matches(text):
+            return idx
+    return -1
+
+
+class MatchCache(object):
+    """
+    Least recently used process class matches by command line, so long
+    running processes aren't matched again every cycle
+    """
+
+    def __init__(self, size, counters):
+        self.size = size
+        self.counters = counters
+        self.entries = collections.OrderedDict()
+
+    def get(self, processText):
+        """ Returns a cached match, or None """
+        try:
+            value = self.entries.pop(processText)
+        except KeyError:
+            self.counters['match_cache_misses'] += 1
+            return None
+        self.entries[processText] = value
+        self.counters['match_cache_hits'] += 1
+        return value
+
+    def put(self, processText, value):
+        """ Caches a match, dropping the least recently used if full """
+        if self.size < 1:
+            return
+        self.entries[processText] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class RestartTracker(object):
+    """
+    PIDs of each component's matching processes over its most recent
+    cycles with any running, kept as sorted arrays of integers. Only
+    configured components are kept.
+    """
+
+    def __init__(self, cycles=1):
+        self.cycles = max(1, cycles)
+        # component -> deque of PID arrays, oldest first
+        self.history = dict()
+
+    def restarted(self, component, pids):
+        """
+        Determines whether all of a component's PIDs changed since the
+        cycles kept
+
+        @parameter component: OSProcess component ID
+        @type component: str
+        @parameter pids: current PIDs
+        @type pids: set
+        @return: whether the processes restarted
+        @rtype: bool
+        """
+        history = self.history.get(component)
+        # No restart if there are no current or previous PIDs.
+        if not pids or not history:
+            return False
+        return pids.isdisjoint(itertools.chain(*history))
+
+    def record(self, pids_by_component, components):
+        """ Keeps a cycle's PIDs, forgetting unconfigured components """
+        components = set(components)
+        for component in set(self.history) - components:
+            del self.history[component]
+
+        for component, pids in pids_by_component.iteritems():
+            if not pids or component not in components:
+                continue
+            history = self.history.get(component)
+            if history is None or history.maxlen != self.cycles:
+                history = collections.deque(history or [], self.cycles)
+                self.history[component] = history
+            history.append(array.array('l', sorted(pids)))
+
+
+class ProcessMatcherIndex(object):
+    """
+    Process class matchers for a config's datasources in sequence order,
+    built once rather than for every process. Processes are only checked
+    against the matchers whose required literal text they contain, and
+    matches are cached for as long as the process classes don't change.
+    """
+
+    def __init__(self, config, cache_size=0, previous=None):
+        self.config = config
+        # (required literal or None, matcher, datasource, ignoreParameters)
+        self.entries = matcher_entries(
+            (datasource.params, datasource)
+            for datasource in sorted(
+                config.datasources,
+                key=lambda x: x.params.get('sequence', 0)
+                )
+            )
+        # Only then can processes with the same text match differently
+        self.ignores = any(entry[3] for entry in self.entries)
+
+        LOG.debug(
+            '%s: Indexed %s process class matchers, %s by literal text',
+            config.id,
+            len(self.entries),
+            len([entry for entry in self.entries if entry[0]])
+            )
+
+        # Cached matches are positions in the entries, which stay valid
+        # across configs as long as the process classes are the same
+        self.fingerprint = tuple(
+            (datasource.component, ignore) + tuple(
+                datasource.params.get(key)
+                for key in ('includeRegex', 'excludeRegex', 'replaceRegex',
+                            'replacement', 'primaryUrlPath', 'generatedId')
+                )
+            for literal, matcher, datasource, ignore in self.entries
+            )
+        if (previous is not None
+                and previous.fingerprint == self.fingerprint
+                and previous.cache.size == cache_size):
+            self.cache = previous.cache
+        else:
+            self.cache = MatchCache(
+                cache_size,
+                match_cache_counters[config.id]
+                )
+
+    def match(self, processText, exe=''):
+        """
+        Returns the first datasource by sequence matching a process
+
+        @parameter processText: process command and arguments
+        @type processText: str
+        @parameter exe: process executable, matched if ignoring parameters
+        @type exe: str
+        @return: matching datasource or None
+        @rtype: PythonDataSourceConfig
+        """
+        key = (processText, exe) if self.ignores else processText
+        position = self.cache.get(key)
+        if position is None:
+            position = first_match(self.entries, processText, exe)
+            self.cache.put(key, position)
+
+        return self.entries[position][2] if position >= 0 else None
+
+
 class Processes(PythonDataSourcePlugin):
     """ NCPA processes data source plugin """
 
@@ -153,6 +384,12 @@ class Processes(PythonDataSourcePlugin):
         params = {
             'token': context.zNcpaToken,
             'port': context.zNcpaPort,
+            'stream': context.zNcpaStreamLargeResponses,
+            'matchCacheSize': context.zNcpaProcessMatchCacheSize,
+            'restartCycles': context.zNcpaProcessRestartCycles,
+            'filter': context.zNcpaFilterProcesses,
+            'maxLength': context.zNcpaProcessMaxLength,
+            'client': ncpaClient.client_settings(context),
             }
 
         # Only set valid params. Different versions of Zenoss have
@@ -170,6 +407,11 @@ class Processes(PythonDataSourcePlugin):
         ip_addr = config.manageIp or config.id
         token = config.datasources[0].params.get('token', '')
         port = int(config.datasources[0].params.get('port', 5693))
+        stream = config.datasources[0].params.get('stream', False)
+        ncpaClient.configure(
+            ncpaUtil.agent_address(ip_addr, port),
+            **config.datasources[0].params.get('client', {})
+            )
 
         if not ip_addr or not token:
             err_str = ('No IP address or hostname' if not ip_addr
@@ -179,6 +421,15 @@ class Processes(PythonDataSourcePlugin):
 
         LOG.debug('%s: Collecting from NCPA client %s', config.id, ip_addr)
 
+        literals = None
+        if (config.datasources[0].params.get('filter', False)
+                and not getattr(self, 'filters_unsupported', False)):
+            literals = process_filters(config.datasources)
+        if literals:
+            table = yield self.collect_filtered(config, literals)
+            if table is not None:
+                returnValue(table)
+
         url = ncpaUtil.build_url(
             host=ip_addr,
             port=port,
@@ -187,77 +438,152 @@ class Processes(PythonDataSourcePlugin):
             params={'aggregate': 'avg'}
             )
 
-        response = yield getPage(url, method='GET')
-        output = json.loads(response)
+        # Metrics are extracted into columns, not kept per process
+        table = ProcessTable(
+            LOG,
+            int(config.datasources[0].params.get('maxLength', 0))
+            )
+        if stream:
+            output = yield ncpaClient.fetch_items(url, 'processes', table.add)
+            if output is None:
+                returnValue(table)
+        else:
+            output = yield ncpaClient.fetch_json(url)
+
         LOG.debug('%s: NCPA API output:\n%s', config.id, str(output))
 
         # This will raise an exception if necessary
         ncpaUtil.error_check(output, config.id, LOG)
-        output = output.get('root', output).get('processes', output)
+        for proc in output.get('root', output).get('processes', output):
+            table.add(proc)
 
-        returnValue(output)
+        returnValue(table)
+
+    @inlineCallbacks
+    def collect_filtered(self, config, literals):
+        """
+        Requests only processes whose command lines contain the literal
+        text, and those without a command line. Returns None if the agent
+        couldn't filter them.
+        """
+        ip_addr = config.manageIp or config.id
+        token = config.datasources[0].params.get('token', '')
+        port = int(config.datasources[0].params.get('port', 5693))
+
+        # (filter, whether a command line passes it)
+        filters = [
+            ({'cmd': literal, 'match': 'search'},
+             lambda cmd, literal=literal: literal in cmd)
+            for literal in literals
+            ]
+        filters.append((
+            {'cmd': NO_COMMAND_LINE, 'match': 'regex'},
+            lambda cmd: cmd in ('', 'Unknown')
+            ))
+
+        urls = list()
+        for params, passes in filters:
+            params = dict(params, aggregate='avg')
+            urls.append(ncpaUtil.build_url(
+                host=ip_addr,
+                port=port,
+                token=token,
+                endpoint='processes',
+                params=params
+                ))
+        outputs = yield ncpaClient.fetch_json_all(urls)
+
+        table = ProcessTable(
+            LOG,
+            int(config.datasources[0].params.get('maxLength', 0))
+            )
+        # Empty is an answer when only candidates are requested
+        table.filtered = True
+        pids = set()
+        for (params, passes), output in zip(filters, outputs):
+            LOG.debug('%s: NCPA API output:\n%s', config.id, str(output))
+            try:
+                ncpaUtil.error_check(output)
+                processes = output.get('root', output)['processes']
+                # Agents that don't know the filter return everything
+                for proc in processes:
+                    if not passes(proc.get('cmd', '') or ''):
+                        raise NcpaError('{0} ignored'.format(params))
+            except NcpaIncorrectCredentialsError:
+                raise
+            except (NcpaError, KeyError), err:
+                LOG.info(
+                    '%s: NCPA agent cannot filter processes, '
+                    'requesting all of them: %s',
+                    config.id,
+                    err
+                    )
+                self.filters_unsupported = True
+                returnValue(None)
+
+            # A process can contain more than one literal
+            for proc in processes:
+                if proc.get('pid') not in pids:
+                    pids.add(proc.get('pid'))
+                    table.add(proc)
+
+        LOG.debug(
+            '%s: %s candidate processes for %s filters',
+            config.id,
+            len(table),
+            len(literals)
+            )
+        returnValue(table)
 
     def onSuccess(self, results, config):
         data = self.new_data()
-        processes = process_metrics(results)
+        # ProcessTable built by collect
+        processes = results
 
-        if not processes:
+        if not processes and not processes.filtered:
             err_str = 'No processes returned by NCPA'
             LOG.error('%s: %s', config.id, err_str)
-            raise ncpaError(err_str)
+            raise NcpaError(err_str)
 
         # Using ZenPacks.zenoss.Microsoft.Windows.datasources.ProcessDataSource
         # as an example for OS process handling
-        datasource_by_pid = dict()
-        metrics_by_component = collections.defaultdict(
-            lambda: collections.defaultdict(list)
-            )
+        datasource_by_component = dict()
+        rows_by_component = collections.defaultdict(list)
+        metrics_by_component = collections.defaultdict(dict)
 
         # Used for process restart checking.
-        if not hasattr(self, 'previous_pids_by_component'):
-            self.previous_pids_by_component = collections.defaultdict(set)
+        cycles = int(config.datasources[0].params.get('restartCycles', 1))
+        tracker = getattr(self, 'restart_tracker', None)
+        if tracker is None:
+            tracker = RestartTracker(cycles)
+            self.restart_tracker = tracker
+        tracker.cycles = max(1, cycles)
 
         pids_by_component = collections.defaultdict(set)
 
-        sorted_datasource = sorted(
-            config.datasources,
-            key=lambda x: x.params.get('sequence', 0)
-            )
-
-        for proc in processes:
-            processText = proc.get(
-                'processText',
-                'THIS_WILL_NEVER_MATCH_ANYTHING'
+        # Matchers only change with the config
+        index = getattr(self, 'matcher_index', None)
+        if index is None or index.config is not config:
+            index = ProcessMatcherIndex(
+                config,
+                int(config.datasources[0].params.get('matchCacheSize', 0)),
+                index
                 )
-            pid = proc.get('pid', -1)
+            self.matcher_index = index
 
-            if -1 == pid:
+        for row, processText in enumerate(processes.cmd):
+            # Don't continue matching once a match is found.
+            datasource = index.match(processText, processes.exe[row])
+            if datasource is None:
                 continue
 
-            for datasource in sorted_datasource:
-                # Assume we're on at least 4.2.5 due to ZPL
-                matcher = OSProcessDataMatcher(
-                    includeRegex=datasource.params['includeRegex'],
-                    excludeRegex=datasource.params['excludeRegex'],
-                    replaceRegex=datasource.params['replaceRegex'],
-                    replacement=datasource.params['replacement'],
-                    primaryUrlPath=datasource.params['primaryUrlPath'],
-                    generatedId=datasource.params['generatedId']
-                    )
-
-                if not matcher.matches(processText):
-                    continue
+            datasource_by_component[datasource.component] = datasource
+            rows_by_component[datasource.component].append(row)
+            pids_by_component[datasource.component].add(processes.pid[row])
 
-                datasource_by_pid[pid] = datasource
-                pids_by_component[datasource.component].add(pid)
-
-                # Track process count. Append 1 each time we find a
-                # match because the generic aggregator below will sum
-                # them up to the total count.
-                metrics_by_component[datasource.component][COUNT_DATAPOINT].append(1)  # noqa
-
-                # Don't continue matching once a match is found.
-                break
+        # Track process count.
+        for component, rows in rows_by_component.iteritems():
+            metrics_by_component[component][COUNT_DATAPOINT] = len(rows)
 
         # Send process status events.
         for datasource in config.datasources:
@@ -267,30 +593,25 @@ class Processes(PythonDataSourcePlugin):
                 severity = 0
                 summary = 'matching processes running'
 
-                # Process restart checking.
-                previous_pids = self.previous_pids_by_component.get(component)
-                current_pids = pids_by_component.get(component)
-
-                # No restart if there are no current or previous PIDs.
-                # previous PIDs.
-                if previous_pids and current_pids:
+                # Process restart checking. Only consider PID changes
+                # a restart if all PIDs matching the process changed.
+                if tracker.restarted(
+                        component,
+                        pids_by_component.get(component)
+                        ):
+                    summary = 'matching processes restarted'
 
-                    # Only consider PID changes a restart if all PIDs
-                    # matching the process changed.
-                    if current_pids.isdisjoint(previous_pids):
-                        summary = 'matching processes restarted'
-
-                        # If the process is configured to alert on
-                        # restart, the first "up" won't be a clear.
-                        if datasource.params['alertOnRestart']:
-                            severity = datasource.params['severity']
+                    # If the process is configured to alert on
+                    # restart, the first "up" won't be a clear.
+                    if datasource.params['alertOnRestart']:
+                        severity = datasource.params['severity']
 
             else:
                 severity = datasource.params['severity']
                 summary = 'no matching processes running'
 
                 # Add a 0 count for process that aren't running.
-                metrics_by_component[component][COUNT_DATAPOINT].append(0)
+                metrics_by_component[component][COUNT_DATAPOINT] = 0
 
             data['events'].append({
                 'device': datasource.device,
@@ -301,43 +622,45 @@ class Processes(PythonDataSourcePlugin):
                 'severity': severity,
             })
 
-        # Prepare for next cycle's restart check by merging current
-        # process PIDs with previous. This is to catch restarts that
-        # stretch across more than subsequent cycles.
-        self.previous_pids_by_component.update(
-            (c, p) for c, p in pids_by_component.iteritems() if p)
+        # Prepare for next cycle's restart check. Components without
+        # PIDs keep their previous ones to catch restarts that stretch
+        # across more than subsequent cycles.
+        tracker.record(
+            pids_by_component,
+            [datasource.component for datasource in config.datasources]
+            )
 
-        for proc in processes:
-            pid = proc.get('pid', -1)
+        for component, rows in rows_by_component.iteritems():
+            datasource = datasource_by_component[component]
+            if LOG.isEnabledFor(logging.DEBUG):
+                for row in rows:
+                    LOG.debug(
+                        '%s %s: Matching process %s',
+                        datasource.device,
+                        component,
+                        processes[row]
+                        )
 
-            if pid not in datasource_by_pid:
-                continue
-            datasource = datasource_by_pid[pid]
             for point in datasource.points:
                 if point.id == COUNT_DATAPOINT:
                     continue
 
-                LOG.debug(
-                    '%s %s: Matching process %s',
-                    datasource.device,
-                    datasource.component,
-                    str(proc)
-                    )
-                if point.id in proc:
-                    value = proc.get(point.id)
-                    metrics_by_component[datasource.component][point.id].append(value)  # noqa
+                if point.id in FIELDS:
+                    # Aggregate datapoint values.
+                    metrics_by_component[component][point.id] = (
+                        processes.sum(FIELDS[point.id], rows)
+                        )
                 else:
                     LOG.warn(
                         '%s %s: %s not in result',
                         datasource.device,
-                        datasource.component,
+                        component,
                         point.id
                         )
 
-        # Aggregate and store datapoint values.
+        # Store datapoint values.
         for component, points in metrics_by_component.iteritems():
-            for point, values in points.iteritems():
-                value = sum(values)
+            for point, value in points.iteritems():
                 data['values'][component][point] = (value, 'N')
 
         # Send overall clear.
@@ -28,3 +28,17 @@ class NcpaNodeDoesNotExistError(NcpaError):
         self.msg = self.value
         self.node = node
         self.path = path
+
+
+class NcpaCircuitOpenError(NcpaError):
+    """ Requests to an unreachable agent are failing fast """
+    def __init__(self, host, failures, retry_in):
+        self.host = host
+        self.failures = failures
+        self.retry_in = retry_in
+        self.value = (
+            'NCPA agent at {0} unreachable after {1} attempts, '
+            'retrying in {2:.0f} seconds'.format(host, failures, retry_in)
+            )
+        self.message = self.value
+        self.msg = self.value
@@ -0,0 +1,695 @@
+""" Shared HTTPS client for the Nagios Cross-Platform Agent API """
+
+import logging
+LOG = logging.getLogger('zen.NCPA.client')
+
+import collections
+import time
+import urlparse
+import zlib
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    CancelledError,
+    Deferred,
+    FirstError,
+    gatherResults,
+    inlineCallbacks,
+    returnValue,
+    succeed
+    )
+from twisted.internet.error import (
+    ConnectError,
+    DNSLookupError,
+    TimeoutError
+    )
+from twisted.internet.protocol import Protocol
+from twisted.internet.ssl import ClientContextFactory
+from twisted.python.failure import Failure
+from twisted.web.client import getPage
+from twisted.web.error import Error
+from zope.interface import classImplements
+try:
+    from twisted.web.client import (
+        Agent,
+        HTTPConnectionPool,
+        ResponseDone,
+        readBody
+        )
+    from twisted.web.http import PotentialDataLoss
+    from twisted.web.http_headers import Headers
+except ImportError:
+    # Twisted is too old for persistent connections, getPage it is
+    Agent = None
+    HTTPConnectionPool = object
+try:
+    from twisted.web.iweb import IPolicyForHTTPS
+except ImportError:
+    IPolicyForHTTPS = None
+
+from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+from ZenPacks.daviswr.NCPA.lib.exceptions import (
+    NcpaCircuitOpenError,
+    NcpaError
+    )
+from ZenPacks.daviswr.NCPA.lib.ncpaStream import NodeItemDecoder
+
+USER_AGENT = 'ZenPacks.daviswr.NCPA'
+
+# Failures to reach an agent at all, rather than errors it returned
+CONNECT_ERRORS = (ConnectError, DNSLookupError, TimeoutError)
+
+# zProperty name, client setting name
+client_properties = (
+    ('zNcpaPoolMaxPerHost', 'max_per_host'),
+    ('zNcpaPoolMaxTotal', 'max_total'),
+    ('zNcpaPoolIdleTimeout', 'idle_timeout'),
+    ('zNcpaRequestReuseWindow', 'reuse_window'),
+    ('zNcpaCompression', 'compression'),
+    ('zNcpaMaxConcurrentRequests', 'max_requests'),
+    ('zNcpaMaxConcurrentPerHost', 'max_requests_per_host'),
+    ('zNcpaCircuitFailures', 'circuit_failures'),
+    ('zNcpaCircuitBackoff', 'circuit_backoff'),
+    )
+device_properties = tuple(prop for prop, setting in client_properties)
+
+# Client settings limiting the collector as a whole rather than a single
+# agent, client setting name -> pool attribute name or None
+collector_settings = {
+    'max_per_host': 'maxPersistentPerHost',
+    'max_total': 'maxPersistentTotal',
+    'idle_timeout': 'cachedConnectionTimeout',
+    'max_requests': None,
+    }
+
+_pool = None
+_agent = None
+
+# host:port -> client settings from the zProperties of the agent's device
+_agent_settings = dict()
+
+# Seconds a decoded response is shared with later requests for its URL,
+# unless the agent's settings say otherwise
+_reuse_window = 0
+# URL -> _Flight
+_flights = dict()
+
+# Whether gzip and deflate responses are accepted, unless the agent's
+# settings say otherwise
+_compression = True
+# host:port -> bytes received on the wire and after decompression
+_transfers = collections.defaultdict(lambda: {'received': 0, 'decoded': 0})
+
+
+class _Scheduler(object):
+    """
+    Limits NCPA requests in flight across the collector and per agent
+    host:port, queueing the rest rather than failing them. Agents with
+    queued requests take turns as requests finish.
+    """
+
+    def __init__(self):
+        self.max_total = 200
+        self.max_per_host = 6
+        self.total = 0
+        self.active = collections.defaultdict(int)
+        # host:port -> deque of (Deferred, time queued), in turn order
+        self.queues = collections.OrderedDict()
+        self.queued = 0
+        self.counters = collections.defaultdict(
+            lambda: {'requests': 0, 'waited': 0, 'wait_time': 0.0}
+            )
+
+    def acquire(self, host):
+        """ Returns a Deferred firing when a request to host may start """
+        self.counters[host]['requests'] += 1
+        if (self.total < self.max_total
+                and self.active[host] < self.host_limit(host)
+                and host not in self.queues):
+            self._start(host)
+            return succeed(None)
+
+        d = Deferred()
+        self.queues.setdefault(host, collections.deque()).append(
+            (d, time.time())
+            )
+        self.queued += 1
+        LOG.debug(
+            'Queued NCPA request to %s, %s queued, %s in flight',
+            host,
+            self.queued,
+            self.total
+            )
+        return d
+
+    def host_limit(self, host):
+        """ Returns the number of requests to host allowed in flight """
+        return int(agent_setting(host, 'max_requests_per_host', 0)
+                   or self.max_per_host)
+
+    def release(self, host):
+        """ Marks a request to host finished and starts queued ones """
+        self.total -= 1
+        self.active[host] -= 1
+        if self.active[host] < 1:
+            del self.active[host]
+
+        ready = list()
+        for _ in range(len(self.queues)):
+            if self.total >= self.max_total:
+                break
+            next_host, queue = self.queues.popitem(last=False)
+            if self.active[next_host] < self.host_limit(next_host):
+                d, queued_at = queue.popleft()
+                self.queued -= 1
+                self.counters[next_host]['waited'] += 1
+                self.counters[next_host]['wait_time'] += (
+                    time.time() - queued_at
+                    )
+                self._start(next_host)
+                ready.append(d)
+            # Back of the line, if there's anything left
+            if queue:
+                self.queues[next_host] = queue
+
+        for d in ready:
+            d.callback(None)
+
+    def _start(self, host):
+        self.total += 1
+        self.active[host] += 1
+
+
+_scheduler = _Scheduler()
+
+
+class _CircuitBreaker(object):
+    """
+    Counts consecutive connection failures per agent host:port. Once
+    there have been enough, requests to the agent fail immediately until
+    the backoff has passed, then a single request probes whether the
+    agent is back while the rest keep failing fast.
+    """
+
+    def __init__(self):
+        self.threshold = 3
+        self.backoff = 300
+        # host:port -> consecutive connection failures
+        self.failures = collections.defaultdict(int)
+        # host:port -> time the circuit opened or was last probed
+        self.opened = dict()
+
+    def check(self, host):
+        """ Raises NcpaCircuitOpenError if requests to host fail fast """
+        if host not in self.opened:
+            return
+
+        remaining = self.opened[host] + self.host_backoff(host) - time.time()
+        if remaining > 0:
+            raise NcpaCircuitOpenError(host, self.failures[host], remaining)
+
+        LOG.info('Probing NCPA agent at %s', host)
+        self.opened[host] = time.time()
+
+    def host_threshold(self, host):
+        """ Returns the connection failures opening host's circuit """
+        return max(0, int(agent_setting(host, 'circuit_failures',
+                                        self.threshold)))
+
+    def host_backoff(self, host):
+        """ Returns the seconds host's open circuit fails requests """
+        return max(0, int(agent_setting(host, 'circuit_backoff',
+                                        self.backoff)))
+
+    def record(self, host, error=None):
+        """ Records how a request to host turned out """
+        if isinstance(error, CancelledError):
+            # Says nothing about the agent
+            return
+
+        if isinstance(error, CONNECT_ERRORS):
+            self.failures[host] += 1
+            threshold = self.host_threshold(host)
+            if threshold and self.failures[host] >= threshold:
+                if host not in self.opened:
+                    LOG.warn(
+                        'NCPA agent at %s unreachable after %s attempts, '
+                        'failing requests for %s seconds',
+                        host,
+                        self.failures[host],
+                        self.host_backoff(host)
+                        )
+                self.opened[host] = time.time()
+
+        elif host in self.failures:
+            if self.opened.pop(host, None):
+                LOG.info('NCPA agent at %s reachable again', host)
+            del self.failures[host]
+
+
+_circuits = _CircuitBreaker()
+
+
+class _Flight(object):
+    """ A single NCPA API request shared by every caller of its URL """
+
+    def __init__(self):
+        self.waiters = list()
+        self.result = None
+        self.done = False
+
+    def wait(self):
+        """ Returns a Deferred firing with the shared result """
+        d = Deferred()
+        if self.done:
+            d.callback(self.result)
+        else:
+            self.waiters.append(d)
+        return d
+
+    def finish(self, result):
+        """ Hands the result, or failure, to every waiting caller """
+        self.result = result
+        self.done = True
+        waiters, self.waiters = self.waiters, list()
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+class _Inflater(object):
+    """ Decompresses a gzip or deflate response body as it arrives """
+
+    def __init__(self, encoding):
+        self.wbits = (16 + zlib.MAX_WBITS if 'gzip' == encoding
+                      else zlib.MAX_WBITS)
+        self.decompressor = zlib.decompressobj(self.wbits)
+        self.started = False
+
+    def inflate(self, data):
+        """ Returns the decompressed data available so far """
+        try:
+            inflated = self.decompressor.decompress(data)
+        except zlib.error:
+            # Some servers send deflate without the zlib header
+            if self.started or zlib.MAX_WBITS != self.wbits:
+                raise
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            inflated = self.decompressor.decompress(data)
+        self.started = True
+        return inflated
+
+    def flush(self):
+        """ Returns the rest of the decompressed data """
+        return self.decompressor.flush()
+
+
+class _DecoderProtocol(Protocol):
+    """ Feeds a response body to an incremental decoder as it arrives """
+
+    def __init__(self, decoder, finished, inflater=None):
+        self.decoder = decoder
+        self.finished = finished
+        self.inflater = inflater
+        self.failure = None
+        self.received = 0
+        self.decoded = 0
+
+    def feed(self, data):
+        """ Passes decompressed data along to the decoder """
+        self.decoded += len(data)
+        self.decoder.feed(data)
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.failure is None:
+            try:
+                self.feed(self.inflater.inflate(data) if self.inflater
+                          else data)
+            except Exception:
+                # Drain the rest of the body, fail once it's done
+                self.failure = Failure()
+
+    def connectionLost(self, reason):
+        if self.failure is None and self.inflater:
+            try:
+                self.feed(self.inflater.flush())
+            except Exception:
+                self.failure = Failure()
+
+        if self.failure is not None:
+            self.finished.errback(self.failure)
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback((self.received, self.decoded))
+        else:
+            self.finished.errback(reason)
+
+
+class NcpaConnectionPool(HTTPConnectionPool):
+    """
+    Persistent connection pool keyed per host:port, with a limit on
+    the number of idle connections cached across all hosts
+    """
+
+    maxPersistentTotal = 1000
+
+    def _putConnection(self, key, connection):
+        """ Caches a connection, evicting the oldest if at the limit """
+        # Every cached connection has an idle timeout scheduled,
+        # and a full per-host list already drops one on its own
+        if (len(self._timeouts) >= self.maxPersistentTotal
+                and len(self._connections.get(key, []))
+                < self.maxPersistentPerHost):
+            oldest = min(
+                self._timeouts,
+                key=lambda conn: self._timeouts[conn].getTime()
+                )
+            for old_key, connections in self._connections.items():
+                if oldest in connections:
+                    self._timeouts[oldest].cancel()
+                    self._removeConnection(old_key, oldest)
+                    break
+
+        HTTPConnectionPool._putConnection(self, key, connection)
+
+
+class _NoVerifyContextFactory(ClientContextFactory):
+    """
+    NCPA listens with a self-signed certificate by default so,
+    like getPage, the agent's certificate is not verified
+    """
+
+    def getContext(self, hostname=None, port=None):
+        return ClientContextFactory.getContext(self)
+
+    def creatorForNetloc(self, hostname, port):
+        return self
+
+
+if IPolicyForHTTPS is not None:
+    classImplements(_NoVerifyContextFactory, IPolicyForHTTPS)
+
+
+def client_settings(obj):
+    """ Returns shared client settings from an object's zProperties """
+    return dict(
+        (setting, getattr(obj, prop))
+        for prop, setting in client_properties
+        if getattr(obj, prop, None) is not None
+        )
+
+
+def agent_setting(host, name, default=None):
+    """ Returns a client setting of the agent at host:port """
+    value = _agent_settings.get(host, dict()).get(name)
+    return default if value is None else value
+
+
+def collector_limit(name):
+    """
+    Returns the highest value of a collector-wide client setting among
+    configured agents, or None if none set it
+    """
+    values = [int(settings[name]) for settings in _agent_settings.values()
+              if settings.get(name)]
+    return max(values) if values else None
+
+
+def _apply_collector_limits():
+    """ Applies collector-wide client settings to the pool and scheduler """
+    for name, attribute in collector_settings.iteritems():
+        limit = collector_limit(name)
+        if not limit:
+            continue
+        elif attribute is None:
+            _scheduler.max_total = limit
+        elif _pool is not None:
+            setattr(_pool, attribute, limit)
+
+
+def configure(address=None, **settings):
+    """
+    Creates the shared connection pool if needed and keeps the client
+    settings of the agent at address, its host:port. Settings limiting
+    the collector as a whole are the highest of any agent's, so they
+    don't depend on which device was collected last, and are only
+    applied again when an agent's settings change.
+    """
+    global _pool, _agent
+
+    changed = False
+    if address is not None and _agent_settings.get(address) != settings:
+        _agent_settings[address] = settings
+        changed = True
+
+    if Agent is not None and _pool is None:
+        _pool = NcpaConnectionPool(reactor, persistent=True)
+        _agent = Agent(reactor, _NoVerifyContextFactory(), pool=_pool)
+        changed = True
+
+    if changed:
+        _apply_collector_limits()
+
+
+def _count_transfer(url, received, decoded):
+    """ Adds a response's sizes to its agent's transfer counters """
+    transfers = _transfers[urlparse.urlsplit(url).netloc]
+    transfers['received'] += received
+    transfers['decoded'] += decoded
+
+
+def transfer_counters(host, port):
+    """
+    Returns the total bytes received from an agent on the wire, the
+    total after decompression and the bytes compression saved
+    """
+    transfers = _transfers.get(ncpaUtil.agent_address(host, port), dict())
+    received = transfers.get('received', 0)
+    decoded = transfers.get('decoded', 0)
+    return {
+        'bytes_received': received,
+        'bytes_decoded': decoded,
+        'bytes_saved': decoded - received,
+        }
+
+
+def request_counters(host, port):
+    """
+    Returns the number of requests made to an agent, how many of those
+    waited in the collector's queue and for how many seconds in total,
+    along with the collector's current number of queued requests
+    """
+    counters = _scheduler.counters.get(
+        ncpaUtil.agent_address(host, port),
+        dict()
+        )
+    return {
+        'requests': counters.get('requests', 0),
+        'waited': counters.get('waited', 0),
+        'wait_time': counters.get('wait_time', 0.0),
+        'queued': _scheduler.queued,
+        }
+
+
+def _inflater(response):
+    """ Returns an _Inflater for a compressed response, or None """
+    encodings = response.headers.getRawHeaders('content-encoding') or []
+    encoding = encodings[-1].strip().lower() if encodings else ''
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        return _Inflater(encoding.replace('x-', ''))
+    return None
+
+
+def _request(url, method='GET'):
+    """ Returns a Deferred firing with the response to a request """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+
+    if _agent is None:
+        configure()
+
+    headers = {'User-Agent': [USER_AGENT]}
+    host = urlparse.urlsplit(url).netloc
+    if agent_setting(host, 'compression', _compression):
+        headers['Accept-Encoding'] = ['gzip, deflate']
+
+    return _agent.request(method, url, Headers(headers), None)
+
+
+@inlineCallbacks
+def fetch(url, method='GET'):
+    """ Returns a Deferred firing with the body of an NCPA API response """
+    host = urlparse.urlsplit(url).netloc
+    _circuits.check(host)
+    yield _scheduler.acquire(host)
+    try:
+        if Agent is None:
+            response = None
+            body = yield getPage(url, method=method)
+        else:
+            response = yield _request(url, method)
+            body = yield readBody(response)
+    except Exception, err:
+        _circuits.record(host, err)
+        raise
+    finally:
+        _scheduler.release(host)
+    _circuits.record(host)
+
+    if response is None:
+        _count_transfer(url, len(body), len(body))
+        returnValue(body)
+
+    received = len(body)
+    inflater = _inflater(response)
+    if inflater:
+        body = inflater.inflate(body) + inflater.flush()
+    _count_transfer(url, received, len(body))
+
+    # Same behavior as getPage
+    if response.code >= 400:
+        raise Error(response.code, response.phrase, body)
+
+    returnValue(body)
+
+
+@inlineCallbacks
+def fetch_items(url, node, consume):
+    """
+    Returns a Deferred firing once every item of an NCPA API node's list
+    or object has been decoded and passed to consume, as the response
+    arrives. Object members are passed as (name, value) tuples. Fires
+    with None, or with the decoded body if it wasn't the node's list or
+    object, such as an NCPA error. These requests are never shared.
+    """
+    decoder = NodeItemDecoder(node, consume)
+    host = urlparse.urlsplit(url).netloc
+    _circuits.check(host)
+    yield _scheduler.acquire(host)
+    try:
+        if Agent is None:
+            body = yield getPage(url)
+            _count_transfer(url, len(body), len(body))
+            decoder.feed(body)
+        else:
+            response = yield _request(url)
+            if response.code >= 400:
+                body = yield readBody(response)
+                raise Error(response.code, response.phrase, body)
+
+            finished = Deferred()
+            response.deliverBody(
+                _DecoderProtocol(decoder, finished, _inflater(response))
+                )
+            received, decoded = yield finished
+            _count_transfer(url, received, decoded)
+    except Exception, err:
+        _circuits.record(host, err)
+        raise
+    finally:
+        _scheduler.release(host)
+    _circuits.record(host)
+
+    LOG.debug(
+        'Decoded %s %s items from %s',
+        decoder.count,
+        node,
+        url.split('?')[0]
+        )
+    returnValue(decoder.close())
+
+
+def _expire_flight(url, flight):
+    """ Stops sharing a finished request """
+    if _flights.get(url) is flight:
+        del _flights[url]
+
+
+def _land_flight(result, url, flight):
+    """ Shares a finished request's result for the reuse window """
+    flight.finish(result)
+    reuse_window = max(0, int(agent_setting(
+        urlparse.urlsplit(url).netloc,
+        'reuse_window',
+        _reuse_window
+        )))
+    # Failures are only shared with callers already waiting
+    if isinstance(result, Failure) or not reuse_window:
+        _expire_flight(url, flight)
+    else:
+        reactor.callLater(reuse_window, _expire_flight, url, flight)
+
+
+def fetch_json(url):
+    """
+    Returns a Deferred firing with the decoded body of an NCPA API
+    response. Callers requesting the same URL while it is in flight, or
+    within the reuse window after, share a single request and decoded
+    object, which must not be modified.
+    """
+    flight = _flights.get(url)
+    if flight is None:
+        flight = _Flight()
+        _flights[url] = flight
+        d = fetch(url)
+        d.addCallback(ncpaUtil.load_json)
+        d.addBoth(_land_flight, url, flight)
+    else:
+        LOG.debug('Sharing NCPA request %s', url.split('?')[0])
+
+    return flight.wait()
+
+
+def _unwrap_first_error(failure):
+    """ Passes along the original failure of a concurrent fetch """
+    failure.trap(FirstError)
+    return failure.value.subFailure
+
+
+def with_timeout(d, seconds, message):
+    """
+    Returns a Deferred firing like d, or failing with an NcpaError with
+    the message if d hasn't fired within seconds. The request behind d
+    isn't cancelled, as it may be shared, and its result is dropped.
+    """
+    result = Deferred()
+
+    def expire():
+        if not result.called:
+            result.errback(Failure(NcpaError(message)))
+
+    call = reactor.callLater(seconds, expire)
+
+    def finished(outcome):
+        if call.active():
+            call.cancel()
+        if result.called:
+            return None
+        if isinstance(outcome, Failure):
+            result.errback(outcome)
+        else:
+            result.callback(outcome)
+        return None
+
+    d.addBoth(finished)
+    return result
+
+
+def gather(deferreds):
+    """
+    Returns a Deferred firing with the results of several concurrent
+    fetches, in order, or the first failure among them
+    """
+    d = gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(_unwrap_first_error)
+    return d
+
+
+def fetch_json_all(urls):
+    """
+    Returns a Deferred firing with the decoded bodies of several NCPA API
+    responses, fetched concurrently, in the same order as the URLs
+    """
+    return gather([fetch_json(url) for url in urls])
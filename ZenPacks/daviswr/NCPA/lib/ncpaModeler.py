@@ -0,0 +1,286 @@
+""" NCPA API collection shared by the modeler plugins """
+
+import collections
+import functools
+import hashlib
+import json
+import time
+
+from twisted.internet.defer import DeferredList, inlineCallbacks, returnValue
+
+from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
+
+from ZenPacks.daviswr.NCPA.lib import ncpaClient, ncpaSnapshot, ncpaUtil
+
+# Modeler plugin that fetches for every other NCPA plugin when enabled
+UNIFIED_PLUGIN = 'daviswr.ncpa.AgentMap'
+
+# (device ID, plugin name) -> (fingerprint of the last results processed,
+# time they were processed). Kept by the zenmodeler daemon, so a device
+# modeled on demand in its own process is always modeled in full.
+_fingerprints = dict()
+# (device ID, plugin name) -> fingerprint of the results being processed
+_processing = dict()
+
+
+def unified(device):
+    """ Returns True if the device is modeled with one set of requests """
+    return UNIFIED_PLUGIN in (getattr(device, 'zCollectorPlugins', ()) or ())
+
+
+def error_message(output):
+    """ Returns the message of an error returned by the NCPA API """
+    error = output['error']
+    return error.get('message', 'an unknown error occurred') \
+        if isinstance(error, dict) else str(error)
+
+
+def collapse_endpoints(endpoints):
+    """
+    Returns fewer endpoints covering the same data: sibling endpoints as
+    their parent, and none already covered by another
+    """
+    requests = set(endpoints)
+    siblings = collections.defaultdict(set)
+    for endpoint in requests:
+        if '/' in endpoint and endpoint not in ncpaUtil.uncovered_nodes:
+            siblings[endpoint.rsplit('/', 1)[0]].add(endpoint)
+    for parent, children in siblings.iteritems():
+        if len(children) > 1:
+            requests -= children
+            requests.add(parent)
+
+    return sorted(
+        endpoint for endpoint in requests
+        if not any(ncpaUtil.covers(other, endpoint) for other in requests)
+        )
+
+
+def endpoint_response(responses, endpoint):
+    """
+    Returns the response to an endpoint, taken from the response to an
+    endpoint covering it if it wasn't requested itself, or None
+    """
+    if endpoint in responses:
+        return responses[endpoint]
+
+    for requested, response in responses.iteritems():
+        if not requested or not ncpaUtil.covers(requested, endpoint):
+            continue
+        value = response.get(requested.split('/')[-1])
+        for name in endpoint[len(requested) + 1:].split('/'):
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is not None:
+            return {endpoint.split('/')[-1]: value}
+
+    return None
+
+
+@inlineCallbacks
+def fetch_endpoints(device, endpoints, log):
+    """
+    Returns a Deferred firing with the decoded responses of NCPA API
+    endpoints by endpoint. Endpoints in the collector's snapshot of the
+    device, if recent enough, are read from it and the rest fetched
+    concurrently, requesting a parent endpoint once for those it covers.
+    Endpoints that failed or returned an error are logged and left out.
+    """
+    token = getattr(device, 'zNcpaToken', None)
+
+    if not token:
+        log.error('%s: zNcpaToken not set', device.id)
+        returnValue(dict())
+
+    max_age = int(getattr(device, 'zNcpaSnapshotMaxAge', 0) or 0)
+    responses = (ncpaSnapshot.load(device.id, endpoints, max_age)
+                 if max_age > 0 else dict())
+    if responses:
+        log.info(
+            '%s: using collector snapshot for NCPA %s',
+            device.id,
+            ', '.join(sorted(responses))
+            )
+        endpoints = [endpoint for endpoint in endpoints
+                     if endpoint not in responses]
+        if not endpoints:
+            returnValue(responses)
+
+    port = getattr(device, 'zNcpaPort', 5693)
+    ncpaClient.configure(
+        ncpaUtil.agent_address(device.manageIp, port),
+        **ncpaClient.client_settings(device)
+        )
+
+    requests = collapse_endpoints(endpoints)
+    urls = list()
+    for endpoint in requests:
+        url = ncpaUtil.build_url(
+            host=device.manageIp,
+            port=port,
+            token=token,
+            endpoint=endpoint
+            )
+        log.debug(
+            '%s: using NCPA %s URL %s',
+            device.id,
+            endpoint,
+            url.split('=')[0]
+            )
+        urls.append(url)
+
+    results = yield DeferredList(
+        [ncpaClient.fetch_json(url) for url in urls],
+        consumeErrors=True
+        )
+
+    fetched = dict()
+    for endpoint, (success, output) in zip(requests, results):
+        if not success:
+            log.error('%s: %s', device.id, output.value)
+        elif 'error' in output:
+            log.error('%s: %s', device.id, error_message(output))
+        else:
+            fetched[endpoint] = output
+
+    for endpoint in endpoints:
+        response = endpoint_response(fetched, endpoint)
+        if response is not None:
+            responses[endpoint] = response
+
+    returnValue(responses)
+
+
+def fingerprint(data):
+    """ Returns a digest of modeler input """
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, default=str)
+        ).hexdigest()
+
+
+def forget_fingerprints(device_id, plugin_name=None):
+    """
+    Makes the next modeling of a device, or one plugin's, apply in full.
+    Other daemons on the collector, such as zenmodeler when called from
+    the Agent datasource, forget all of the device's.
+    """
+    for key in list(_fingerprints):
+        if key[0] == device_id and plugin_name in (None, key[1]):
+            del _fingerprints[key]
+    ncpaSnapshot.mark_remodeled(device_id)
+
+
+def fingerprinted(process):
+    """
+    Decorates a plugin's process() so the results NcpaPlugin.unchanged
+    compared are only remembered once they've been made into maps
+    """
+    @functools.wraps(process)
+    def wrapper(self, device, results, log):
+        key = (device.id, self.name())
+        _processing.pop(key, None)
+        try:
+            maps = process(self, device, results, log)
+        except Exception:
+            forget_fingerprints(device.id, self.name())
+            raise
+
+        digest = _processing.pop(key, None)
+        if digest is not None and maps is not None:
+            _fingerprints[key] = (digest, time.time())
+        return maps
+
+    return wrapper
+
+
+def merge_responses(responses, endpoints):
+    """
+    Returns the responses to endpoints merged into the results a plugin
+    processes, or None if any of them is missing
+    """
+    # Shared responses must not be modified
+    output = dict()
+    for endpoint in endpoints:
+        if endpoint not in responses:
+            return None
+        output.update(responses[endpoint])
+    return output
+
+
+class NcpaPlugin(PythonPlugin):
+    """ Modeler plugin processing responses from NCPA API endpoints """
+
+    # Endpoints whose responses are merged into the results processed
+    endpoints = ()
+    # What's being modeled, for logging
+    collecting = 'data'
+
+    deviceProperties = PythonPlugin.deviceProperties + (
+        'zNcpaToken',
+        'zNcpaPort',
+        'zCollectorPlugins',
+        'zNcpaModelFingerprintAge',
+        'zNcpaSnapshotMaxAge',
+        ) + ncpaClient.device_properties
+
+    @inlineCallbacks
+    def collect(self, device, log):
+        """ Asynchronously collect data from device. Return a deferred. """
+        if unified(device):
+            log.debug(
+                '%s: %s collected by %s',
+                device.id,
+                self.name(),
+                UNIFIED_PLUGIN
+                )
+            returnValue(None)
+
+        log.info('%s: collecting %s', device.id, self.collecting)
+        responses = yield fetch_endpoints(device, self.endpoints, log)
+        returnValue(merge_responses(responses, self.endpoints))
+
+    @classmethod
+    def model_properties(cls):
+        """ Returns the zProperties the plugin's maps depend on """
+        return tuple(
+            prop for prop in cls.deviceProperties
+            if prop not in NcpaPlugin.deviceProperties
+            )
+
+    def model_input(self, results):
+        """
+        Returns the parts of results the plugin's maps are built from, or
+        None if they change too often to be worth comparing
+        """
+        return None
+
+    def unchanged(self, device, results, log):
+        """
+        Returns True if the plugin's input and zProperties are the same as
+        when the device was last modeled, so there's nothing to apply.
+        Results are applied anyway once zNcpaModelFingerprintAge seconds
+        have passed since they were, or if the device was remodeled since.
+        Only remembered by process() decorated with fingerprinted.
+        """
+        max_age = int(getattr(device, 'zNcpaModelFingerprintAge', 0) or 0)
+        data = self.model_input(results)
+        if max_age <= 0 or data is None:
+            return False
+
+        properties = [
+            getattr(device, prop, None) for prop in self.model_properties()
+            ]
+        digest = fingerprint([data, properties])
+        key = (device.id, self.name())
+        previous, seen = _fingerprints.get(key, (None, 0))
+        if (previous == digest
+                and time.time() - seen < max_age
+                and seen > ncpaSnapshot.remodeled(device.id)):
+            log.info(
+                '%s: %s unchanged since last modeled',
+                device.id,
+                self.name()
+                )
+            return True
+
+        _processing[key] = digest
+        return False
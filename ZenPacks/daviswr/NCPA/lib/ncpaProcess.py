@@ -0,0 +1,217 @@
+""" Compact table of the processes returned by the NCPA API """
+
+import logging
+LOG = logging.getLogger('zen.NCPA.process')
+
+import array
+import heapq
+
+from ZenPacks.daviswr.NCPA.lib.ncpaUtil import multipliers
+
+# CPU will always read 100% if System Idle is included
+IDLE_PROCESS = 'System Idle Process'
+
+# Process metric name -> ProcessTable column
+FIELDS = {
+    'cpu': 'cpu_percent',
+    'mem': 'mem_rss',
+    'pid': 'pid',
+    'processText': 'cmd',
+    }
+
+# Columns stored as floats that are reported as integers
+INTEGER_COLUMNS = ('mem_rss', 'mem_vms')
+
+
+def command_line(proc):
+    """ Returns the text identifying an api/processes entry """
+    cmd = proc.get('cmd', '') or proc.get('exe', '')
+    if 'Unknown' == cmd or not cmd:
+        cmd = proc.get('name', '')
+    return cmd
+
+
+def executable(proc):
+    """ Returns the executable of an api/processes entry, if reported """
+    exe = proc.get('exe', '') or proc.get('name', '')
+    return '' if 'Unknown' == exe else exe
+
+
+def normalize_command(cmd, max_length=0):
+    """
+    Returns process text as it's matched against process classes, when
+    collecting and modeling alike: without surrounding whitespace and
+    no longer than max_length, if given
+    """
+    cmd = cmd.strip()
+    if max_length > 0:
+        cmd = cmd[:max_length]
+    return cmd
+
+
+def strip_parameters(cmd, exe=''):
+    """
+    Returns process text without parameters, for ignoreParameters. NCPA
+    doesn't quote command lines, so the executable it reported is used
+    if there is one rather than splitting a path like C:\\Program Files.
+    """
+    if exe:
+        return exe
+    if cmd.startswith('"'):
+        # Such as "C:\Program Files\App\app.exe" --service
+        end = cmd.find('"', 1)
+        if end > 0:
+            return cmd[1:end]
+    return cmd.split(None, 1)[0] if cmd else cmd
+
+
+class ProcessRow(object):
+    """
+    A process in a ProcessTable, read from the table's columns. Offers
+    the process metrics by FIELDS name like a dict would.
+    """
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __contains__(self, key):
+        return key in FIELDS
+
+    def __getitem__(self, key):
+        return self.table.value(FIELDS[key], self.row)
+
+    def get(self, key, default=None):
+        """ Returns a process metric by name """
+        if key not in FIELDS:
+            return default
+        return self[key]
+
+    def __str__(self):
+        return str(dict((key, self[key]) for key in FIELDS))
+
+
+class ProcessTable(object):
+    """
+    The processes from an api/processes response, built in one pass and
+    stored column by column rather than as a dict per process
+    """
+
+    def __init__(self, log=None, max_length=0):
+        self.pid = array.array('l')
+        # Bytes, floats don't overflow where C longs are 32 bits
+        self.mem_rss = array.array('d')
+        self.mem_vms = array.array('d')
+        self.cpu_percent = array.array('d')
+        self.mem_percent = array.array('d')
+        self.cmd = list()
+        # Executable or process name, empty if NCPA didn't report either
+        self.exe = list()
+        # Rows of System Idle Process
+        self.idle = list()
+        # Logger for the process class test UI's line, if wanted
+        self.log = log
+        # Only processes that could match were requested
+        self.filtered = False
+        # Longest process text kept, 0 for no limit
+        self.max_length = max_length
+        self._strings = dict()
+
+    def __len__(self):
+        return len(self.pid)
+
+    def __getitem__(self, row):
+        return ProcessRow(self, row)
+
+    def __iter__(self):
+        for row in xrange(len(self.pid)):
+            yield ProcessRow(self, row)
+
+    def add(self, proc):
+        """ Adds a process entry from api/processes """
+        try:
+            pid = int(proc['pid'])
+            rss = proc['mem_rss']
+            rss = float(rss[0]) * multipliers.get(rss[1], 1)
+            vms = proc.get('mem_vms', [0, 'B'])
+            vms = float(vms[0]) * multipliers.get(vms[1], 1)
+            cpu = float(proc['cpu_percent'][0])
+            mem = float(proc.get('mem_percent', [0.0, '%'])[0])
+            cmdAndArgs = normalize_command(
+                command_line(proc),
+                self.max_length
+                )
+            exe = normalize_command(executable(proc), self.max_length)
+        except Exception:
+            LOG.warn("Unable to parse entry '%s'", str(proc))
+            return
+
+        if self.log is not None and self.log.isEnabledFor(logging.DEBUG):
+            # ----------------------------------------------------------
+            # WARNING! Do not modify this debug line at all!
+            # The process class interactive testing UI depends on it!
+            # (yeah, yeah... technical debt... we know)
+            # ----------------------------------------------------------
+            self.log.debug("line '%s' -> pid=%s rss=%s cpu=%s cmdAndArgs=%s",
+                           str(proc), pid, int(rss), cpu, cmdAndArgs)
+            # ----------------------------------------------------------
+
+        if IDLE_PROCESS == proc.get('name'):
+            self.idle.append(len(self.pid))
+
+        self.pid.append(pid)
+        self.mem_rss.append(rss)
+        self.mem_vms.append(vms)
+        # NCPA returns current CPU percent rather than time
+        # so it can be graphed and mapped to cpu_pct directly
+        self.cpu_percent.append(cpu)
+        self.mem_percent.append(mem)
+        # Many processes share a command line
+        self.cmd.append(self._strings.setdefault(cmdAndArgs, cmdAndArgs))
+        self.exe.append(self._strings.setdefault(exe, exe))
+
+    def value(self, column, row):
+        """ Returns a column's value for a row """
+        value = getattr(self, column)[row]
+        return int(value) if column in INTEGER_COLUMNS else value
+
+    def sum(self, column, rows=None):
+        """ Returns the sum of a column, for the given rows or all of them """
+        values = getattr(self, column)
+        if rows is not None:
+            values = [values[row] for row in rows]
+        value = sum(values)
+        return int(value) if column in INTEGER_COLUMNS else value
+
+    def top(self, column, count):
+        """
+        Returns the processes with the highest values of a column, as
+        (process text, PID, value, executable), without System Idle
+        Process. Only count rows are kept on a heap rather than sorting
+        them all.
+        """
+        values = getattr(self, column)
+        idle = set(self.idle)
+        rows = heapq.nlargest(
+            count,
+            (row for row in xrange(len(values)) if row not in idle),
+            key=values.__getitem__
+            )
+        return [
+            (self.cmd[row], self.pid[row], self.value(column, row),
+             self.exe[row])
+            for row in rows
+            ]
+
+    def totals(self):
+        """ Returns device-level sums, without System Idle Process CPU """
+        return {
+            'mem_rss': self.sum('mem_rss'),
+            'mem_vms': self.sum('mem_vms'),
+            'proc_cpu': (self.sum('cpu_percent')
+                         - self.sum('cpu_percent', self.idle)),
+            'proc_mem': self.sum('mem_percent'),
+            'processes': len(self) - len(self.idle),
+            }
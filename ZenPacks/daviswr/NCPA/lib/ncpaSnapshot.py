@@ -0,0 +1,159 @@
+"""
+NCPA API data collected by the Agent datasource, stored on the collector
+for modeler plugins to read instead of asking the agent again
+"""
+
+import logging
+LOG = logging.getLogger('zen.NCPA.snapshot')
+
+import json
+import os
+import tempfile
+import time
+
+from urllib import quote
+
+from twisted.internet.threads import deferToThread
+
+from Products.ZenUtils.Utils import zenPath
+
+from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+
+# Top-level nodes not kept as the API returns them, such as processes,
+# which the Agent datasource only keeps the sums of
+UNSHARED_NODES = ('avg', 'processes')
+
+
+def snapshot_path(device_id):
+    """ Returns the file a device's snapshot is stored in """
+    return zenPath(
+        'var',
+        'ncpa',
+        'snapshots',
+        '{0}.json'.format(quote(device_id, safe=''))
+        )
+
+
+def remodel_path(device_id):
+    """ Returns the file marking when a device was last remodeled """
+    return zenPath(
+        'var',
+        'ncpa',
+        'remodeled',
+        quote(device_id, safe='')
+        )
+
+
+def mark_remodeled(device_id):
+    """
+    Records that a device's model may differ from what zenmodeler last
+    applied, such as after the Agent datasource remodeled components
+    """
+    path = remodel_path(device_id)
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'a'):
+            os.utime(path, None)
+    except (IOError, OSError), err:
+        LOG.warn('%s: Unable to mark remodeled: %s', device_id, err)
+
+
+def remodeled(device_id):
+    """ Returns when a device was last marked remodeled, 0 if never """
+    try:
+        return os.path.getmtime(remodel_path(device_id))
+    except (IOError, OSError):
+        return 0
+
+
+def save(device_id, nodes, output):
+    """
+    Stores the NCPA API nodes collected for a device, in the tree the
+    Agent datasource grafts them into. The file is written in a thread,
+    so the reactor doesn't wait on the disk.
+
+    @parameter device_id: device ID
+    @type device_id: str
+    @parameter nodes: API node paths requested
+    @type nodes: list
+    @parameter output: responses grafted at their paths
+    @type output: dict
+    @return: Deferred firing once written, or None if there's nothing to
+    @rtype: Deferred
+    """
+    nodes = [node for node in nodes
+             if node.split('/')[0] not in UNSHARED_NODES]
+    if not nodes:
+        return None
+
+    # Taken now, output can change once the thread is running
+    tree = dict(
+        (name, value) for name, value in output.iteritems()
+        if name not in UNSHARED_NODES
+        )
+    return deferToThread(
+        write,
+        device_id,
+        {'time': time.time(), 'nodes': nodes, 'tree': tree}
+        )
+
+
+def write(device_id, snapshot):
+    """ Writes a device's snapshot file, replacing the previous one """
+    path = snapshot_path(device_id)
+    directory = os.path.dirname(path)
+    temp = None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Readers see the previous snapshot or this one, never part of it
+        handle, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'w') as stored:
+            json.dump(snapshot, stored)
+        os.rename(temp, path)
+    except (IOError, OSError, TypeError, ValueError), err:
+        LOG.warn('%s: Unable to save NCPA snapshot: %s', device_id, err)
+        if temp and os.path.exists(temp):
+            os.remove(temp)
+
+
+def load(device_id, endpoints, max_age):
+    """
+    Returns responses to NCPA API endpoints by endpoint, taken from a
+    device's snapshot if it's no older than max_age seconds. Endpoints
+    the snapshot doesn't include in full are left out.
+
+    @parameter device_id: device ID
+    @type device_id: str
+    @parameter endpoints: API endpoints, such as disk/logical
+    @type endpoints: list
+    @parameter max_age: seconds
+    @type max_age: int
+    @return: responses as the API would return them, by endpoint
+    @rtype: dict
+    """
+    responses = dict()
+    try:
+        with open(snapshot_path(device_id)) as snapshot:
+            stored = ncpaUtil.load_json(snapshot.read())
+    except (IOError, OSError, ValueError):
+        return responses
+
+    if time.time() - stored.get('time', 0) > max_age:
+        return responses
+
+    nodes = stored.get('nodes', [])
+    for endpoint in endpoints:
+        if not any(node == endpoint or ncpaUtil.covers(node, endpoint)
+                   for node in nodes):
+            continue
+
+        value = stored.get('tree', dict())
+        for name in endpoint.split('/'):
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is not None:
+            responses[endpoint] = {endpoint.split('/')[-1]: value}
+
+    return responses
@@ -0,0 +1,155 @@
+""" Incremental decoding of large NCPA API responses """
+
+import json
+import re
+
+from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Only the standard library decodes part of a string, it is also
+# C-accelerated in Python 2.7
+_decoder = json.JSONDecoder()
+
+
+class NodeItemDecoder(object):
+    """
+    Decodes the items of an NCPA API node's list or object, such as
+    {"processes": [...]}, from a response body as it arrives rather than
+    decoding the whole body at once. Each list item, or (name, value)
+    pair of an object, is passed to consume as soon as it is complete.
+    """
+
+    def __init__(self, node, consume):
+        self.node = node
+        self.consume = consume
+        self.count = 0
+        self.buffer = ''
+        self.pos = 0
+        # open, key, container, items, done or whole
+        self.state = 'open'
+        self.container = None
+
+    def feed(self, data):
+        """ Decodes as many complete items as possible from more data """
+        if 'done' == self.state:
+            return
+
+        self.buffer += data
+        self._advance(final=False)
+
+        # Decoded items are dropped, but the whole body is kept until
+        # it's known to be the expected node
+        if self.state in ('items', 'done'):
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+
+    def close(self):
+        """
+        Finishes decoding at the end of the body. Returns None if the
+        node's items were decoded, otherwise the decoded body, which is
+        likely an NCPA error.
+        """
+        if self.state not in ('items', 'done'):
+            self.state = 'whole'
+            return ncpaUtil.load_json(self.buffer)
+
+        self._advance(final=True)
+        if 'done' != self.state:
+            raise ValueError('Truncated NCPA API response')
+
+        return None
+
+    def _skip(self):
+        """ Skips whitespace, returns the next character if available """
+        self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+        return self.buffer[self.pos] if self.pos < len(self.buffer) else ''
+
+    def _decode(self, final):
+        """ Decodes the next value, returns (value,) or None if partial """
+        try:
+            value, end = _decoder.raw_decode(self.buffer, self.pos)
+        except ValueError:
+            if final:
+                raise
+            return None
+
+        # A number at the end of the data may have more digits coming
+        if end >= len(self.buffer) and not final:
+            return None
+
+        self.pos = end
+        return (value,)
+
+    def _advance(self, final):
+        """ Moves through the buffer as far as the data allows """
+        while self.state not in ('done', 'whole'):
+            char = self._skip()
+            if not char:
+                return
+
+            if 'open' == self.state:
+                if '{' != char:
+                    self.state = 'whole'
+                    return
+                self.pos += 1
+                self.state = 'key'
+
+            elif 'key' == self.state:
+                start = self.pos
+                key = self._decode(final)
+                if key is None:
+                    return
+                if ':' != self._skip():
+                    # Separator hasn't arrived yet
+                    self.pos = start
+                    return
+                self.pos += 1
+                if 'root' == key[0]:
+                    self.state = 'open'
+                elif self.node == key[0]:
+                    self.state = 'container'
+                else:
+                    self.state = 'whole'
+
+            elif 'container' == self.state:
+                if char not in '[{':
+                    self.state = 'whole'
+                    return
+                self.container = char
+                self.pos += 1
+                self.state = 'items'
+
+            elif char in ']}':
+                self.state = 'done'
+
+            elif ',' == char:
+                self.pos += 1
+
+            elif not self._decode_item(final):
+                return
+
+    def _decode_item(self, final):
+        """ Passes the next complete item along, False if partial """
+        start = self.pos
+        if '{' == self.container:
+            name = self._decode(final)
+            if name is None or ':' != self._skip():
+                self.pos = start
+                return False
+            self.pos += 1
+            self._skip()
+            value = self._decode(final)
+            if value is None:
+                self.pos = start
+                return False
+            item = (name[0], value[0])
+        else:
+            value = self._decode(final)
+            if value is None:
+                return False
+            item = value[0]
+
+        self.count += 1
+        self.consume(item)
+        return True
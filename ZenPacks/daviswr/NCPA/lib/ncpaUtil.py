@@ -1,5 +1,8 @@
 """ A library of NCPA-related functions """
 
+import json
+import re
+
 from urllib import quote, urlencode
 
 from Products.ZenEvents import Event
@@ -24,6 +27,39 @@ multipliers = {
     'PB': 1000**5,
     }
 
+# Nagios plugin performance data, 'label'=value[UOM];[warn];[crit];[min];[max]
+perfdata_value_pattern = (
+    # Label, single-quoted if it contains spaces, starting a word so
+    # thresholds aren't rescanned for one
+    r"(?<!\S)('[^']*(?:''[^']*)*'|[^\s'=]+)="
+    # Value, or U if it couldn't be determined
+    r"(U|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+    )
+# Only labels and values, when thresholds and limits aren't wanted. The
+# rest of each item is skipped rather than scanned for labels.
+perfdata_values_only = re.compile(perfdata_value_pattern + r"\S*")
+perfdata_pattern = re.compile(
+    perfdata_value_pattern +
+    # Unit of measure
+    r"([^\s;]*)"
+    # Warning and critical thresholds, minimum and maximum
+    r";?([^\s;]*);?([^\s;]*);?([^\s;]*);?([^\s;]*)"
+    )
+
+# Datapoint suffixes of thresholds and limits in perfdata_pattern order
+perfdata_limits = ('warn', 'crit', 'min', 'max')
+
+# JSON modules to decode API responses with, in order of preference,
+# with the module that must import for each to be C-accelerated
+json_decoders = (
+    ('ujson', 'ujson'),
+    ('simplejson', 'simplejson._speedups'),
+    ('json', 'json'),
+    )
+
+# NCPA API nodes returned as empty lists by their parent nodes
+uncovered_nodes = ('avg/cpu/percent', 'cpu/percent', 'processes', 'services')
+
 service_states = {
     'running': 0,
     'stopped': 1,
@@ -36,24 +72,39 @@ service_states = {
     }
 
 
-def build_url(host, port, token, endpoint=None, params=None):
-    """ Returns an NCPA API endpoint URL """
-    api_params = {'token': token, 'units': 'B'}
-    api_params.update(params if params else {})
-
+def agent_address(host, port):
+    """ Returns an NCPA agent's host:port, as in its API URLs """
     # Unsure if this check is necessary
     if ((isinstance(port, str) and not port.isdigit())
             or not isinstance(port, int)):
         port = 5693
 
-    return 'https://{0}:{1}/api/{2}?{3}'.format(
-        host,
-        port,
+    return '{0}:{1}'.format(host, port)
+
+
+def build_url(host, port, token, endpoint=None, params=None):
+    """ Returns an NCPA API endpoint URL """
+    api_params = {'token': token, 'units': 'B'}
+    api_params.update(params if params else {})
+
+    # Sorted so identical requests have identical URLs
+    return 'https://{0}/api/{1}?{2}'.format(
+        agent_address(host, port),
         quote(endpoint) if endpoint else '',
-        urlencode(api_params)
+        urlencode(sorted(api_params.items()))
         )
 
 
+def covers(parent, node):
+    """ Whether an NCPA API node's response includes another node """
+    if node == parent or node in uncovered_nodes:
+        return False
+    elif not parent:
+        return not node.startswith('avg/')
+    else:
+        return node.startswith(parent + '/')
+
+
 def error_check(output, device=None, log=None):
     """ Checks for error message in NCPA API output and raise an exception """
     if 'error' in output:
@@ -78,42 +129,134 @@ def error_check(output, device=None, log=None):
             raise NcpaError(err_str)
 
 
+def select_json_decoder(name=None):
+    """
+    Selects the module used to decode NCPA API responses, the first
+    available of json_decoders unless a name is given.
+    Returns the name of the module selected.
+    """
+    global _json_loads
+
+    for module_name, accelerator in json_decoders:
+        if name and name != module_name:
+            continue
+        try:
+            __import__(accelerator)
+            module = __import__(module_name)
+        except ImportError:
+            continue
+        _json_loads = module.loads
+        return module_name
+
+    raise ImportError('JSON decoder {0} is not available'.format(name))
+
+
+def load_json(data):
+    """ Decodes an NCPA API response """
+    try:
+        return _json_loads(data)
+    except ValueError:
+        # Faster decoders can be stricter than the standard library
+        if _json_loads is json.loads:
+            raise
+        return json.loads(data)
+
+
 def get_unit_value(value, unit):
     """ Returns value multiplied by given unit """
     return int(float(value) * multipliers.get(unit, 1))
 
 
+def perfdata_number(text):
+    """ Returns a performance data number, or None if there isn't one """
+    if not text or 'U' == text:
+        return None
+    try:
+        return (float(text) if '.' in text or 'e' in text or 'E' in text
+                else int(text))
+    except ValueError:
+        # Such as a threshold range
+        return None
+
+
+def perfdata_label(label):
+    """ Returns a performance data label without quoting """
+    if label.startswith("'"):
+        return label[1:-1].replace("''", "'")
+    return label
+
+
+def split_plugin_output(stdout):
+    """
+    Splits Nagios plugin output into its status text, long text and
+    performance data. Performance data may follow the status text on the
+    first line and a | in the long text, continuing to the end.
+    """
+    # Common case, a single line
+    if '\n' not in stdout:
+        text, _, perf = stdout.partition('|')
+        return text.strip(), '', perf
+
+    first, _, rest = stdout.partition('\n')
+    text, _, perf = first.partition('|')
+
+    long_text, bar, more_perf = rest.partition('|')
+    if bar:
+        perf = '{0} {1}'.format(perf, more_perf)
+    return text.strip(), long_text.strip(), perf
+
+
+def perfdata_values(perf, limits=False):
+    """
+    Returns datapoint values from Nagios performance data by label and,
+    if limits, thresholds and limits that are plain numbers as label_warn,
+    label_crit, label_min and label_max
+    """
+    values = dict()
+    if '=' not in perf:
+        return values
+
+    pattern = perfdata_pattern if limits else perfdata_values_only
+    for item in pattern.findall(perf):
+        value = item[1]
+        if 'U' == value:
+            continue
+        label = item[0]
+        if "'" == label[0]:
+            label = perfdata_label(label)
+        values[label] = (float(value) if '.' in value or 'e' in value
+                         or 'E' in value else int(value))
+        if not limits:
+            continue
+        for suffix, limit in zip(perfdata_limits, item[3:]):
+            limit = perfdata_number(limit)
+            if limit is not None:
+                values['{0}_{1}'.format(label, suffix)] = limit
+
+    return values
+
+
+def nagios_severity(text):
+    """ Returns the event severity for Nagios plugin status text """
+    state = text.upper()
+    if 'WARNING' in state:
+        return Event.Warning
+    elif 'CRITICAL' in state:
+        return Event.Error
+    elif 'OK' not in state:
+        return Event.Warning
+    return Event.Clear
+
+
 def parse_nagios(stdout):
     """ Parses Nagios-style datapoint output """
-    values = dict()
-    state, value_str = stdout.split('|') if '|' in stdout else (stdout, '')
-
-    if 'WARNING' in state.upper():
-        severity = Event.Warning
-    elif 'CRITICAL' in state.upper():
-        severity = Event.Error
-    elif 'OK' not in state.upper():
-        severity = Event.Warning
-    else:
-        severity = Event.Clear
-
-    if value_str:
-        # Make thresholds easy to ignore
-        pairs = value_str.replace(';', ' ').split(' ')
-        for pair in pairs:
-            # Only process actual key-value pairs
-            if '=' in pair:
-                key, value = pair.split('=')
-                # Clean up included units
-                if not value.isdigit():
-                    new_value = ''
-                    for char in value:
-                        if char in '0123456789-.':
-                            new_value += char
-                    value = new_value
-                if value:
-                    values.update({
-                        key: float(value) if '.' in value else int(value)
-                        })
-
-    return state, severity, values
+    if '|' not in stdout:
+        state = stdout.partition('\n')[0].strip()
+        return state, nagios_severity(state), dict()
+
+    state, _, perf = split_plugin_output(stdout)
+    return state, nagios_severity(state), perfdata_values(perf)
+
+
+_json_loads = json.loads
+select_json_decoder()
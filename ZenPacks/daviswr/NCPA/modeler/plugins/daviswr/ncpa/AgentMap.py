@@ -0,0 +1,107 @@
+__doc__ = """
+Models everything the other NCPA modeler plugins do using one set of
+concurrent requests to the Nagios Cross-Platform Agent
+"""
+
+import collections
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from ZenPacks.daviswr.NCPA.lib.ncpaModeler import (
+    NcpaPlugin,
+    fetch_endpoints,
+    merge_responses
+    )
+from ZenPacks.daviswr.NCPA.modeler.plugins.daviswr.ncpa import (
+    CpuMap,
+    DeviceMap,
+    FileSystemMap,
+    HardDiskMap,
+    InterfaceMap,
+    ProcessMap,
+    ServiceMap
+    )
+
+# Plugins whose process() is fed from the shared responses
+PLUGINS = (
+    DeviceMap.DeviceMap,
+    CpuMap.CpuMap,
+    HardDiskMap.HardDiskMap,
+    FileSystemMap.FileSystemMap,
+    InterfaceMap.InterfaceMap,
+    ProcessMap.ProcessMap,
+    ServiceMap.ServiceMap,
+    )
+
+
+class AgentMap(NcpaPlugin):
+    """
+    Nagios Cross-Platform Agent single-fetch modeler plugin. Fetches the
+    endpoints of every NCPA plugin in zCollectorPlugins, or all of them
+    if none are, and processes the results with each plugin. The plugins
+    themselves don't make requests while this one is enabled, returning
+    no results, so it's best enabled alone. Endpoints covered by another
+    are fetched once, through it.
+    """
+
+    deviceProperties = tuple(collections.OrderedDict.fromkeys(
+        prop
+        for plugin in (NcpaPlugin,) + PLUGINS
+        for prop in plugin.deviceProperties
+        ))
+
+    def __init__(self):
+        super(AgentMap, self).__init__()
+        self.plugins = [plugin() for plugin in PLUGINS]
+
+    def enabled_plugins(self, device):
+        """ Returns the plugins to model the device with """
+        enabled = getattr(device, 'zCollectorPlugins', ()) or ()
+        plugins = [plugin for plugin in self.plugins
+                   if plugin.name() in enabled]
+        return plugins or self.plugins
+
+    @inlineCallbacks
+    def collect(self, device, log):
+        """ Asynchronously collect data from device. Return a deferred. """
+        plugins = self.enabled_plugins(device)
+        log.info(
+            '%s: collecting %s',
+            device.id,
+            ', '.join(plugin.collecting for plugin in plugins)
+            )
+
+        endpoints = tuple(collections.OrderedDict.fromkeys(
+            endpoint
+            for plugin in plugins
+            for endpoint in plugin.endpoints
+            ))
+        responses = yield fetch_endpoints(device, endpoints, log)
+        returnValue(responses or None)
+
+    def process(self, device, results, log):
+        """ Process results. Return iterable of datamaps or None. """
+        maps = list()
+
+        for plugin in self.enabled_plugins(device):
+            output = merge_responses(results, plugin.endpoints)
+            if output is None:
+                log.warning(
+                    '%s: %s not modeled, NCPA data missing',
+                    device.id,
+                    plugin.name()
+                    )
+                continue
+
+            try:
+                datamaps = plugin.process(device, output, log)
+            except Exception:
+                log.exception('%s: %s failed', device.id, plugin.name())
+                continue
+
+            if isinstance(datamaps, list):
+                maps.extend(datamaps)
+            elif datamaps is not None:
+                maps.append(datamaps)
+
+        return maps
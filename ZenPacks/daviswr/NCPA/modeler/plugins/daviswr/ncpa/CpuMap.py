@@ -2,18 +2,12 @@ __doc__ = """
 Models processors using the Nagios Cross-Platform Agent
 """
 
-import json
-
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
-
-from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
 from Products.DataCollector.plugins.DataMaps import MultiArgs
 
-from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+from ZenPacks.daviswr.NCPA.lib.ncpaModeler import NcpaPlugin, fingerprinted
 
 
-class CpuMap(PythonPlugin):
+class CpuMap(NcpaPlugin):
     """ Nagios Cross-Platform Agent CPU modeler plugin """
 
     maptype = 'CPUMap'
@@ -21,70 +15,20 @@ class CpuMap(PythonPlugin):
     relname = 'cpus'
     modname = 'Products.ZenModel.CPU'
 
-    deviceProperties = PythonPlugin.deviceProperties + (
-        'zNcpaToken',
-        'zNcpaPort',
-        )
-
-    @inlineCallbacks
-    def collect(self, device, log):
-        """ Asynchronously collect data from device. Return a deferred. """
-        log.info('%s: collecting processors', device.id)
-
-        token = getattr(device, 'zNcpaToken', None)
-
-        if not token:
-            log.error('%s: zNcpaToken not set', device.id)
-            returnValue(None)
-
-        cpu_url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='cpu/count'
-            )
-
-        sys_url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='system/processor'
-            )
-
-        log.debug(
-            '%s: using NCPA CPU URL %s',
-            device.id,
-            cpu_url.split('=')[0]
-            )
-        log.debug(
-            '%s: using NCPA System URL %s',
-            device.id,
-            sys_url.split('=')[0]
-            )
-
-        try:
-            response = yield getPage(cpu_url, method='GET')
-            output = json.loads(response)
-
-            response = yield getPage(sys_url, method='GET')
-            output.update(json.loads(response))
-
-            if 'error' in output:
-                error = output['error']
-                err_str = error.get('message', 'an unknown error occurred') \
-                    if isinstance(error, dict) else str(error)
-                log.error('%s: %s', device.id, err_str)
-                returnValue(None)
-
-        except Exception, err:
-            log.error('%s: %s', device.id, err)
-            returnValue(None)
-
-        returnValue(output)
+    endpoints = ('cpu/count', 'system/processor')
+    collecting = 'processors'
+
+    def model_input(self, results):
+        """ Returns the core counts and processor model """
+        return [results.get('count'), results.get('processor')]
 
+    @fingerprinted
     def process(self, device, results, log):
         """ Process results. Return iterable of datamaps or None. """
 
+        if self.unchanged(device, results, log):
+            return None
+
         count = 0
         if len(results.get('count', [])) > 1:
             # Could be a list of cores per socket?
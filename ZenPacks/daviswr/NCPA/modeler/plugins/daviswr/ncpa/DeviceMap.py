@@ -2,85 +2,36 @@ __doc__ = """
 Models device-level attributes using the Nagios Cross-Platform Agent
 """
 
-import json
-
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
-
-from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
 from Products.DataCollector.plugins.DataMaps import MultiArgs, ObjectMap
 
 from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+from ZenPacks.daviswr.NCPA.lib.ncpaModeler import NcpaPlugin, fingerprinted
 
 
-class DeviceMap(PythonPlugin):
+class DeviceMap(NcpaPlugin):
     """ Nagios Cross-Platform Agent device modeler plugin """
 
-    deviceProperties = PythonPlugin.deviceProperties + (
-        'zNcpaToken',
-        'zNcpaPort',
-        )
-
-    @inlineCallbacks
-    def collect(self, device, log):
-        """ Asynchronously collect data from device. Return a deferred. """
-        log.info('%s: collecting device data', device.id)
-
-        token = getattr(device, 'zNcpaToken', None)
-
-        if not token:
-            log.error('%s: zNcpaToken not set', device.id)
-            returnValue(None)
-
-        sys_url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='system'
-            )
-
-        mem_url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='memory'
-            )
-
-        log.debug(
-            '%s: using NCPA system URL %s',
-            device.id,
-            sys_url.split('=')[0]
-            )
-
-        log.debug(
-            '%s: using NCPA memory URL %s',
-            device.id,
-            mem_url.split('=')[0]
-            )
-
-        try:
-            response = yield getPage(sys_url, method='GET')
-            output = json.loads(response)
-
-            response = yield getPage(mem_url, method='GET')
-            output.update(json.loads(response))
-
-            if 'error' in output:
-                error = output['error']
-                err_str = error.get('message', 'an unknown error occurred') \
-                    if isinstance(error, dict) else str(error)
-                log.error('%s: %s', device.id, err_str)
-                returnValue(None)
-
-        except Exception, err:
-            log.error('%s: %s', device.id, err)
-            returnValue(None)
-
-        returnValue(output)
+    endpoints = ('system', 'memory')
+    collecting = 'device data'
 
+    def model_input(self, results):
+        """ Returns the modeled system attributes and memory totals """
+        system = results.get('system', {})
+        memory = results.get('memory', {})
+        return [
+            [system.get(key) for key in
+             ('node', 'system', 'release', 'version', 'machine', 'processor')],
+            memory.get('virtual', {}).get('total'),
+            memory.get('swap', {}).get('total'),
+            ]
+
+    @fingerprinted
     def process(self, device, results, log):
         """ Process results. Return iterable of datamaps or None. """
 
+        if self.unchanged(device, results, log):
+            return None
+
         vendors = {
             'AIX': 'IBM',
             'Darwin': 'Apple',
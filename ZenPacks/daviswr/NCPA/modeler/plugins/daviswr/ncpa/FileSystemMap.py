@@ -16,14 +16,9 @@ Models filesystems using the Nagios Cross-Platform Agent
 """
 
 import re
-import json
-
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
-
-from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
 
 from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+from ZenPacks.daviswr.NCPA.lib.ncpaModeler import NcpaPlugin, fingerprinted
 
 
 def guess_block_size(bytes):
@@ -47,7 +42,7 @@ def guess_block_size(bytes):
     return 4096
 
 
-class FileSystemMap(PythonPlugin):
+class FileSystemMap(NcpaPlugin):
     """ Nagios Cross-Platform Agent filesystem modeler plugin """
 
     maptype = 'FileSystemMap'
@@ -56,54 +51,27 @@ class FileSystemMap(PythonPlugin):
     #modname = 'Products.ZenModel.FileSystem'
     modname = 'ZenPacks.daviswr.NCPA.FileSystem'
 
-    deviceProperties = PythonPlugin.deviceProperties + (
-        'zNcpaToken',
-        'zNcpaPort',
+    endpoints = ('disk/logical',)
+    collecting = 'filesystems'
+
+    deviceProperties = NcpaPlugin.deviceProperties + (
         'zFileSystemMapIgnoreNames',
         'zFileSystemMapIgnoreTypes',
         )
 
-    @inlineCallbacks
-    def collect(self, device, log):
-        """ Asynchronously collect data from device. Return a deferred. """
-        log.info('%s: collecting filesystems', device.id)
-
-        token = getattr(device, 'zNcpaToken', None)
-
-        if not token:
-            log.error('%s: zNcpaToken not set', device.id)
-            returnValue(None)
-
-        url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='disk/logical'
-            )
-
-        log.debug(
-            '%s: using NCPA filesystem URL %s',
-            device.id,
-            url.split('=')[0]
+    def model_input(self, results):
+        """ Returns the filesystem attributes that are modeled """
+        return dict(
+            (filesystem, [
+                fs_dict.get('device_name'),
+                fs_dict.get('fstype'),
+                fs_dict.get('opts'),
+                fs_dict.get('total'),
+                ])
+            for filesystem, fs_dict in results['logical'].iteritems()
             )
 
-        try:
-            response = yield getPage(url, method='GET')
-            output = json.loads(response)
-
-            if 'error' in output:
-                error = output['error']
-                err_str = error.get('message', 'an unknown error occurred') \
-                    if isinstance(error, dict) else str(error)
-                log.error('%s: %s', device.id, err_str)
-                returnValue(None)
-
-        except Exception, err:
-            log.error('%s: %s', device.id, err)
-            returnValue(None)
-
-        returnValue(output)
-
+    @fingerprinted
     def process(self, device, results, log):
         """ Process results. Return iterable of datamaps or None. """
 
@@ -111,6 +79,9 @@ class FileSystemMap(PythonPlugin):
             log.error('Unable to get filesystems for %s', device.id)
             return None
 
+        if self.unchanged(device, results, log):
+            return None
+
         ignore_re = getattr(device, 'zFileSystemMapIgnoreNames', '')
         if ignore_re:
             log.debug(
@@ -159,6 +130,8 @@ class FileSystemMap(PythonPlugin):
             if not ignore:
                 om = self.objectMap()
                 om.mount = path
+                # Item name the Agent datasource requests it by
+                om.ncpaKey = filesystem
                 om.storageDevice = fs_dict.get('device_name', '')[0]
                 om.type = fs_dict.get('fstype', '')
                 fs_size, fs_unit = fs_dict.get('total', [0, ''])
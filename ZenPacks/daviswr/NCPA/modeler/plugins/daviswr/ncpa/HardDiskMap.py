@@ -3,17 +3,11 @@ Models physical storage volumes using the Nagios Cross-Platform Agent
 """
 
 import re
-import json
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
+from ZenPacks.daviswr.NCPA.lib.ncpaModeler import NcpaPlugin, fingerprinted
 
-from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
 
-from ZenPacks.daviswr.NCPA.lib import ncpaUtil
-
-
-class HardDiskMap(PythonPlugin):
+class HardDiskMap(NcpaPlugin):
     """ Nagios Cross-Platform Agent physical storage modeler plugin """
 
     maptype = 'HardDiskMap'
@@ -21,53 +15,18 @@ class HardDiskMap(PythonPlugin):
     relname = 'harddisks'
     modname = 'Products.ZenModel.HardDisk'
 
-    deviceProperties = PythonPlugin.deviceProperties + (
-        'zNcpaToken',
-        'zNcpaPort',
+    endpoints = ('disk/physical',)
+    collecting = 'physical storage volumes'
+
+    deviceProperties = NcpaPlugin.deviceProperties + (
         'zHardDiskMapMatch',
         )
 
-    @inlineCallbacks
-    def collect(self, device, log):
-        """ Asynchronously collect data from device. Return a deferred. """
-        log.info('%s: collecting physical storage volumes', device.id)
-
-        token = getattr(device, 'zNcpaToken', None)
-
-        if not token:
-            log.error('%s: zNcpaToken not set', device.id)
-            returnValue(None)
-
-        url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='disk/physical'
-            )
-
-        log.debug(
-            '%s: using NCPA phys disk URL %s',
-            device.id,
-            url.split('=')[0]
-            )
-
-        try:
-            response = yield getPage(url, method='GET')
-            output = json.loads(response)
-
-            if 'error' in output:
-                error = output['error']
-                err_str = error.get('message', 'an unknown error occurred') \
-                    if isinstance(error, dict) else str(error)
-                log.error('%s: %s', device.id, err_str)
-                returnValue(None)
-
-        except Exception, err:
-            log.error('%s: %s', device.id, err)
-            returnValue(None)
-
-        returnValue(output)
+    def model_input(self, results):
+        """ Returns the storage volume names """
+        return sorted(results['physical'])
 
+    @fingerprinted
     def process(self, device, results, log):
         """ Process results. Return iterable of datamaps or None. """
 
@@ -75,6 +34,9 @@ class HardDiskMap(PythonPlugin):
             log.error('Unable to get physical storage for %s', device.id)
             return None
 
+        if self.unchanged(device, results, log):
+            return None
+
         harddisk_re = getattr(device, 'zHardDiskMapMatch', '')
         if harddisk_re:
             log.debug(
@@ -3,17 +3,11 @@ Models network interfaces using the Nagios Cross-Platform Agent
 """
 
 import re
-import json
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
+from ZenPacks.daviswr.NCPA.lib.ncpaModeler import NcpaPlugin, fingerprinted
 
-from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
 
-from ZenPacks.daviswr.NCPA.lib import ncpaUtil
-
-
-class InterfaceMap(PythonPlugin):
+class InterfaceMap(NcpaPlugin):
     """ Nagios Cross-Platform Agent interface modeler plugin """
 
     maptype = 'InterfaceMap'
@@ -21,53 +15,18 @@ class InterfaceMap(PythonPlugin):
     relname = 'interfaces'
     modname = 'Products.ZenModel.IpInterface'
 
-    deviceProperties = PythonPlugin.deviceProperties + (
-        'zNcpaToken',
-        'zNcpaPort',
+    endpoints = ('interface',)
+    collecting = 'interfaces'
+
+    deviceProperties = NcpaPlugin.deviceProperties + (
         'zInterfaceMapIgnoreNames',
         )
 
-    @inlineCallbacks
-    def collect(self, device, log):
-        """ Asynchronously collect data from device. Return a deferred. """
-        log.info('%s: collecting interfaces', device.id)
-
-        token = getattr(device, 'zNcpaToken', None)
-
-        if not token:
-            log.error('%s: zNcpaToken not set', device.id)
-            returnValue(None)
-
-        url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='interface'
-            )
-
-        log.debug(
-            '%s: using NCPA interface URL %s',
-            device.id,
-            url.split('=')[0]
-            )
-
-        try:
-            response = yield getPage(url, method='GET')
-            output = json.loads(response)
-
-            if 'error' in output:
-                error = output['error']
-                err_str = error.get('message', 'an unknown error occurred') \
-                    if isinstance(error, dict) else str(error)
-                log.error('%s: %s', device.id, err_str)
-                returnValue(None)
-
-        except Exception, err:
-            log.error('%s: %s', device.id, err)
-            returnValue(None)
-
-        returnValue(output)
+    def model_input(self, results):
+        """ Returns the interface names """
+        return sorted(results['interface'])
 
+    @fingerprinted
     def process(self, device, results, log):
         """ Process results. Return iterable of datamaps or None. """
 
@@ -75,6 +34,9 @@ class InterfaceMap(PythonPlugin):
             log.error('Unable to get interfaces for %s', device.id)
             return None
 
+        if self.unchanged(device, results, log):
+            return None
+
         ignore_re = getattr(device, 'zInterfaceMapIgnoreNames', '')
         if ignore_re:
             log.debug(
@@ -2,18 +2,23 @@ __doc__ = """
 Models processes using the Nagios Cross-Platform Agent
 """
 
-import json
+import collections
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
+from Products.ZenModel.OSProcessMatcher import (
+    OSProcessClassDataMatcher,
+    buildObjectMapData
+    )
 
-from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
-from Products.ZenModel.OSProcessMatcher import buildObjectMapData
+from ZenPacks.daviswr.NCPA.lib.ncpaModeler import NcpaPlugin
+from ZenPacks.daviswr.NCPA.lib.ncpaProcess import (
+    command_line,
+    executable,
+    normalize_command,
+    strip_parameters
+    )
 
-from ZenPacks.daviswr.NCPA.lib import ncpaUtil
 
-
-class ProcessMap(PythonPlugin):
+class ProcessMap(NcpaPlugin):
     """ Nagios Cross-Platform Agent processes modeler plugin """
 
     maptype = 'OSProcessMap'
@@ -21,52 +26,14 @@ class ProcessMap(PythonPlugin):
     relname = 'processes'
     modname = 'Products.ZenModel.OSProcess'
 
-    deviceProperties = PythonPlugin.deviceProperties + (
+    endpoints = ('processes',)
+    collecting = 'processes'
+
+    deviceProperties = NcpaPlugin.deviceProperties + (
         'osProcessClassMatchData',
-        'zNcpaToken',
-        'zNcpaPort',
+        'zNcpaProcessMaxLength',
         )
 
-    @inlineCallbacks
-    def collect(self, device, log):
-        """ Asynchronously collect data from device. Return a deferred. """
-        log.info('%s: collecting processes', device.id)
-
-        token = getattr(device, 'zNcpaToken', None)
-
-        if not token:
-            log.error('%s: zNcpaToken not set', device.id)
-            returnValue(None)
-
-        url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='processes',
-            )
-
-        log.debug(
-            '%s: using NCPA processes URL %s', device.id,
-            url.split('=')[0]
-            )
-
-        try:
-            response = yield getPage(url, method='GET')
-            output = json.loads(response)
-
-            if 'error' in output:
-                error = output['error']
-                err_str = error.get('message', 'an unknown error occurred') \
-                    if isinstance(error, dict) else str(error)
-                log.error('%s: %s', device.id, err_str)
-                returnValue(None)
-
-        except Exception, err:
-            log.error('%s: %s', device.id, err)
-            returnValue(None)
-
-        returnValue(output)
-
     def process(self, device, results, log):
         """ Process results. Return iterable of datamaps or None. """
 
@@ -75,11 +42,12 @@ class ProcessMap(PythonPlugin):
             return None
 
         match_data = device.osProcessClassMatchData
+        max_length = int(getattr(device, 'zNcpaProcessMaxLength', 0) or 0)
         cmds = list()
+        exes = list()
         for proc in results['processes']:
-            cmd = proc.get('cmd', '') or proc.get('exe', '')
-            cmd = proc.get('name') if 'Unknown' == cmd or not cmd else cmd
-            cmd = cmd.strip()
+            # Same process text as the Processes datasource matches
+            cmd = normalize_command(command_line(proc), max_length)
             if cmd:
                 log.debug(
                     '%s: %s\tprocess: %s',
@@ -88,10 +56,46 @@ class ProcessMap(PythonPlugin):
                     cmd
                     )
                 cmds.append(cmd)
+                exes.append(normalize_command(executable(proc), max_length))
             else:
                 log.warn('Skipping process with no name')
 
         rm = self.relMap()
-        rm.extend(map(self.objectMap, buildObjectMapData(match_data, cmds)))
+        if any(data.get('ignoreParameters') for data in match_data):
+            om_data = self.match_by_class(match_data, cmds, exes)
+        else:
+            om_data = buildObjectMapData(match_data, cmds)
+        rm.extend(map(self.objectMap, om_data))
         log.debug('%s RelMap:\n%s', self.name(), str(rm))
         return rm
+
+    def match_by_class(self, match_data, cmds, exes):
+        """
+        Matches process text against process classes in order, for when
+        some ignore parameters. Each process only goes to the first class
+        it matches, as with the Processes datasource.
+        """
+        # Class matchers, as buildObjectMapData builds them, since the
+        # match data has no component to compare generated IDs with
+        classes = list()
+        for data in match_data:
+            data = dict(data)
+            ignore = bool(data.pop('ignoreParameters', False))
+            classes.append((data, OSProcessClassDataMatcher(**data), ignore))
+
+        texts = collections.defaultdict(list)
+        for cmd, exe in zip(cmds, exes):
+            stripped = strip_parameters(cmd, exe)
+            for position, (data, matcher, ignore) in enumerate(classes):
+                text = stripped if ignore else cmd
+                if matcher.matches(text):
+                    texts[position].append(text)
+                    break
+
+        # Processes of a class can share an ID, like buildObjectMapData
+        om_data = collections.OrderedDict()
+        for position, (data, matcher, ignore) in enumerate(classes):
+            if position in texts:
+                for om in buildObjectMapData([data], texts[position]):
+                    om_data.setdefault(om.get('id'), om)
+        return om_data.values()
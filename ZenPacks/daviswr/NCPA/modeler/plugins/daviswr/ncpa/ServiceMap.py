@@ -2,70 +2,30 @@ __doc__ = """
 Models services using the Nagios Cross-Platform Agent
 """
 
-import json
-
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
-
-from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
-
 from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+from ZenPacks.daviswr.NCPA.lib.ncpaModeler import NcpaPlugin, fingerprinted
 
 
-class ServiceMap(PythonPlugin):
+class ServiceMap(NcpaPlugin):
     """ Nagios Cross-Platform Agent service modeler plugin """
 
     relname = 'ncpaServices'
     modname = 'ZenPacks.daviswr.NCPA.Service'
 
-    deviceProperties = PythonPlugin.deviceProperties + (
-        'zNcpaToken',
-        'zNcpaPort',
+    endpoints = ('services',)
+    collecting = 'services'
+
+    deviceProperties = NcpaPlugin.deviceProperties + (
         'zNcpaServicesExpectedRunning',
         'zNcpaServicesExpectedStopped',
         'zNcpaServicesIgnored',
         )
 
-    @inlineCallbacks
-    def collect(self, device, log):
-        """ Asynchronously collect data from device. Return a deferred. """
-        log.info('%s: collecting services', device.id)
-
-        token = getattr(device, 'zNcpaToken', None)
-
-        if not token:
-            log.error('%s: zNcpaToken not set', device.id)
-            returnValue(None)
-
-        url = ncpaUtil.build_url(
-            host=device.manageIp,
-            port=getattr(device, 'zNcpaPort', 5693),
-            token=token,
-            endpoint='services',
-            )
-
-        log.debug(
-            '%s: using NCPA services URL %s', device.id,
-            url.split('=')[0]
-            )
-
-        try:
-            response = yield getPage(url, method='GET')
-            output = json.loads(response)
-
-            if 'error' in output:
-                error = output['error']
-                err_str = error.get('message', 'an unknown error occurred') \
-                    if isinstance(error, dict) else str(error)
-                log.error('%s: %s', device.id, err_str)
-                returnValue(None)
-
-        except Exception, err:
-            log.error('%s: %s', device.id, err)
-            returnValue(None)
-
-        returnValue(output)
+    def model_input(self, results):
+        """ Returns the service names """
+        return sorted(results['services'])
 
+    @fingerprinted
     def process(self, device, results, log):
         """ Process results. Return iterable of datamaps or None. """
 
@@ -73,6 +33,9 @@ class ServiceMap(PythonPlugin):
             log.error('Unable to get services for %s', device.id)
             return None
 
+        if self.unchanged(device, results, log):
+            return None
+
         run_list = getattr(device, 'zNcpaServicesExpectedRunning', [])
         stop_list = getattr(device, 'zNcpaServicesExpectedStopped', [])
         ignore_list = getattr(device, 'zNcpaServicesIgnored', [])
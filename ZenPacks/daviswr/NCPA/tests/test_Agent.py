@@ -0,0 +1,141 @@
+""" Tests for the NCPA API nodes requested by the Agent datasource """
+
+import unittest
+
+from ZenPacks.daviswr.NCPA.dsplugins.Agent import (
+    narrow_nodes,
+    required_nodes
+    )
+
+
+class Point(object):
+    """ Stands in for a datapoint config """
+
+    def __init__(self, id):
+        self.id = id
+
+
+class Source(object):
+    """ Stands in for a datasource config """
+
+    def __init__(self, datasource, points, **params):
+        self.datasource = datasource
+        self.points = [Point(point) for point in points]
+        self.params = params
+
+
+class TestRequiredNodes(unittest.TestCase):
+
+    def test_device_datapoints(self):
+        datasources = [
+            Source('agent', ['memory_used', 'swap_used', 'sysUpTime']),
+            Source('agent', ['cpu_percent', 'users']),
+            ]
+        self.assertEqual(
+            required_nodes(datasources),
+            set(['memory/virtual', 'memory/swap', 'system', 'avg/cpu',
+                 'avg/cpu/percent', 'user'])
+            )
+
+    def test_collector_counters_need_no_nodes(self):
+        datasources = [
+            Source('agent', ['bytes_received', 'request_waited']),
+            Source('agent', ['match_cache_hits']),
+            ]
+        self.assertEqual(required_nodes(datasources), set())
+
+    def test_component_datasources(self):
+        datasources = [
+            Source('cpu', ['percent', 'idle']),
+            Source('services', ['state']),
+            ]
+        self.assertEqual(
+            required_nodes(datasources),
+            set(['cpu', 'cpu/percent', 'services'])
+            )
+
+    def test_cpu_from_counters(self):
+        datasources = [
+            Source('agent', ['cpu_percent']),
+            Source('cpu', ['percent']),
+            ]
+        self.assertEqual(
+            required_nodes(datasources, cpu_from_counters=True),
+            set(['avg/cpu', 'cpu'])
+            )
+
+    def test_keyed_components(self):
+        datasources = [
+            Source('disk', ['used'], key='C:|'),
+            Source('disk', ['used'], key='D:|'),
+            Source('intf', ['bytes_recv'], key='eth0'),
+            Source('diskstats', ['read_bytes']),
+            ]
+        self.assertEqual(
+            required_nodes(datasources),
+            set(['disk/logical/C:|', 'disk/logical/D:|',
+                 'interface/eth0', 'disk/physical'])
+            )
+
+    def test_whole_nodes(self):
+        datasources = [
+            Source('disk', ['used'], key='C:|'),
+            Source('intf', ['bytes_recv'], key='eth0'),
+            ]
+        self.assertEqual(
+            required_nodes(datasources, whole=['disk', 'diskstats']),
+            set(['disk/logical', 'disk/physical', 'interface/eth0'])
+            )
+
+
+class TestNarrowNodes(unittest.TestCase):
+
+    def test_single_node(self):
+        self.assertEqual(narrow_nodes(['cpu']), set(['cpu']))
+
+    def test_siblings_by_parent(self):
+        self.assertEqual(
+            narrow_nodes(['memory/virtual', 'memory/swap']),
+            set(['memory'])
+            )
+
+    def test_siblings_collapse_repeatedly(self):
+        self.assertEqual(
+            narrow_nodes(['disk/logical/C:|', 'disk/logical/D:|',
+                          'disk/physical']),
+            set(['disk'])
+            )
+
+    def test_covered_nodes_dropped(self):
+        self.assertEqual(
+            narrow_nodes(['disk', 'disk/logical/C:|', 'system']),
+            set(['disk', 'system'])
+            )
+
+    def test_uncovered_nodes_kept(self):
+        self.assertEqual(
+            narrow_nodes(['cpu', 'cpu/percent', 'avg/cpu',
+                          'avg/cpu/percent']),
+            set(['cpu', 'cpu/percent', 'avg/cpu', 'avg/cpu/percent'])
+            )
+
+    def test_root_for_many_top_level_nodes(self):
+        self.assertEqual(
+            narrow_nodes(['cpu', 'memory/virtual', 'system', 'user',
+                          'processes', 'avg/cpu']),
+            set(['', 'processes', 'avg/cpu'])
+            )
+
+    def test_few_top_level_nodes_kept(self):
+        self.assertEqual(
+            narrow_nodes(['cpu', 'memory/virtual', 'system', 'processes']),
+            set(['cpu', 'memory/virtual', 'system', 'processes'])
+            )
+
+
+def test_suite():
+    """ Returns the tests for Zenoss's runtests """
+    return unittest.TestSuite([
+        unittest.makeSuite(TestRequiredNodes),
+        unittest.makeSuite(TestNarrowNodes),
+        ])
@@ -0,0 +1,113 @@
+""" Tests for incremental decoding of NCPA API responses """
+
+import json
+import unittest
+
+from ZenPacks.daviswr.NCPA.lib.ncpaStream import NodeItemDecoder
+
+PROCESSES = [
+    {'name': 'python', 'pid': 101, 'cmd': 'python -c "print(1)"'},
+    {'name': 'sshd', 'pid': 20, 'cmd': '/usr/sbin/sshd -D'},
+    {'name': 'init', 'pid': 1, 'cmd': '/sbin/init'},
+    ]
+
+
+def decode(node, chunks):
+    """ Returns the items decoded from chunks and what close() returned """
+    items = list()
+    decoder = NodeItemDecoder(node, items.append)
+    for chunk in chunks:
+        decoder.feed(chunk)
+    return items, decoder.close()
+
+
+class TestNodeItemDecoder(unittest.TestCase):
+
+    def test_whole_body(self):
+        body = json.dumps({'processes': PROCESSES})
+        items, output = decode('processes', [body])
+        self.assertEqual(items, PROCESSES)
+        self.assertEqual(output, None)
+
+    def test_every_chunk_boundary(self):
+        body = json.dumps({'processes': PROCESSES})
+        for split in xrange(1, len(body)):
+            items, output = decode('processes', [body[:split], body[split:]])
+            self.assertEqual(items, PROCESSES, 'split at {0}'.format(split))
+            self.assertEqual(output, None)
+
+    def test_byte_at_a_time(self):
+        body = json.dumps({'processes': PROCESSES}, indent=2)
+        items, output = decode('processes', list(body))
+        self.assertEqual(items, PROCESSES)
+        self.assertEqual(output, None)
+
+    def test_number_split_across_chunks(self):
+        items, output = decode('counts', ['{"counts": [12', '34, 5', '6]}'])
+        self.assertEqual(items, [1234, 56])
+        self.assertEqual(output, None)
+
+    def test_root_wrapper(self):
+        body = json.dumps({'root': {'processes': PROCESSES}})
+        for split in xrange(1, len(body)):
+            items, output = decode('processes', [body[:split], body[split:]])
+            self.assertEqual(items, PROCESSES, 'split at {0}'.format(split))
+            self.assertEqual(output, None)
+
+    def test_object_members(self):
+        body = '{"services": {"sshd": "running", "cron": "stopped"}}'
+        for split in xrange(1, len(body)):
+            items, output = decode('services', [body[:split], body[split:]])
+            self.assertEqual(
+                items,
+                [('sshd', 'running'), ('cron', 'stopped')],
+                'split at {0}'.format(split)
+                )
+
+    def test_empty_list(self):
+        items, output = decode('processes', ['{"processes": [ ]}'])
+        self.assertEqual(items, [])
+        self.assertEqual(output, None)
+
+    def test_error_returned_whole(self):
+        error = {'error': {'message': 'Incorrect credentials given.'}}
+        items, output = decode('processes', [json.dumps(error)])
+        self.assertEqual(items, [])
+        self.assertEqual(output, error)
+
+    def test_other_node_returned_whole(self):
+        body = {'root': {'services': {'sshd': 'running'}}}
+        items, output = decode('processes', [json.dumps(body)])
+        self.assertEqual(items, [])
+        self.assertEqual(output, body)
+
+    def test_truncated_between_items(self):
+        body = json.dumps({'processes': PROCESSES})
+        cut = body.rindex('{', 0, body.index('"init"'))
+        items = list()
+        decoder = NodeItemDecoder('processes', items.append)
+        decoder.feed(body[:cut])
+        self.assertEqual(items, PROCESSES[:2])
+        self.assertRaises(ValueError, decoder.close)
+
+    def test_truncated_within_item(self):
+        body = json.dumps({'processes': PROCESSES})
+        items = list()
+        decoder = NodeItemDecoder('processes', items.append)
+        decoder.feed(body[:body.index('sshd')])
+        self.assertEqual(items, PROCESSES[:1])
+        self.assertRaises(ValueError, decoder.close)
+
+    def test_truncated_number(self):
+        items = list()
+        decoder = NodeItemDecoder('counts', items.append)
+        decoder.feed('{"counts": [1, 23')
+        self.assertEqual(items, [1])
+        self.assertRaises(ValueError, decoder.close)
+
+
+def test_suite():
+    """ Returns the tests for Zenoss's runtests """
+    return unittest.TestSuite([
+        unittest.makeSuite(TestNodeItemDecoder),
+        ])
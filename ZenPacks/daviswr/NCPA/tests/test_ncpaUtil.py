@@ -0,0 +1,136 @@
+""" Tests for Nagios plugin output parsing """
+
+import unittest
+
+from Products.ZenEvents import Event
+
+from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+
+
+class TestPerfdataValues(unittest.TestCase):
+
+    def test_plain_labels(self):
+        self.assertEqual(
+            ncpaUtil.perfdata_values('load1=0.5 load5=0.25 procs=112'),
+            {'load1': 0.5, 'load5': 0.25, 'procs': 112}
+            )
+
+    def test_quoted_labels(self):
+        perf = "'C:\\ Used Space'=10.5GB;20;30;0;40 'it''s'=5 plain=1"
+        self.assertEqual(
+            ncpaUtil.perfdata_values(perf),
+            {'C:\\ Used Space': 10.5, "it's": 5, 'plain': 1}
+            )
+
+    def test_label_with_equals_sign_quoted(self):
+        self.assertEqual(
+            ncpaUtil.perfdata_values("'a=b'=3"),
+            {'a=b': 3}
+            )
+
+    def test_units_and_exponents(self):
+        self.assertEqual(
+            ncpaUtil.perfdata_values('time=0.02s size=1e3B neg=-4%'),
+            {'time': 0.02, 'size': 1000.0, 'neg': -4}
+            )
+
+    def test_unknown_values_skipped(self):
+        self.assertEqual(
+            ncpaUtil.perfdata_values('up=U down=2'),
+            {'down': 2}
+            )
+
+    def test_thresholds_not_labels(self):
+        # Threshold text after a value isn't mistaken for another item
+        self.assertEqual(
+            ncpaUtil.perfdata_values('rta=1.2ms;x=1;500;0 pl=0%;20;60'),
+            {'rta': 1.2, 'pl': 0}
+            )
+
+    def test_limits(self):
+        self.assertEqual(
+            ncpaUtil.perfdata_values(
+                "'used space'=40GB;80;90;0;100 users=3;;;0",
+                limits=True
+                ),
+            {
+                'used space': 40,
+                'used space_warn': 80,
+                'used space_crit': 90,
+                'used space_min': 0,
+                'used space_max': 100,
+                'users': 3,
+                'users_min': 0,
+                }
+            )
+
+    def test_limit_ranges_skipped(self):
+        self.assertEqual(
+            ncpaUtil.perfdata_values('temp=42;@10:20;~:50;0.5', limits=True),
+            {'temp': 42, 'temp_min': 0.5}
+            )
+
+    def test_no_perfdata(self):
+        self.assertEqual(ncpaUtil.perfdata_values(''), {})
+        self.assertEqual(ncpaUtil.perfdata_values(' no values '), {})
+
+
+class TestSplitPluginOutput(unittest.TestCase):
+
+    def test_single_line(self):
+        self.assertEqual(
+            ncpaUtil.split_plugin_output('OK - 3 users | users=3;5;10\n'),
+            ('OK - 3 users', '', ' users=3;5;10')
+            )
+
+    def test_single_line_without_perfdata(self):
+        self.assertEqual(
+            ncpaUtil.split_plugin_output('WARNING - disk filling'),
+            ('WARNING - disk filling', '', '')
+            )
+
+    def test_long_output(self):
+        stdout = '\n'.join([
+            'OK - all disks fine | /=10GB',
+            '/ 10GB of 40GB',
+            '/var 2GB of 8GB | /var=2GB;6;7',
+            "'/srv data'=5GB",
+            ])
+        text, long_text, perf = ncpaUtil.split_plugin_output(stdout)
+        self.assertEqual(text, 'OK - all disks fine')
+        self.assertEqual(long_text, '/ 10GB of 40GB\n/var 2GB of 8GB')
+        self.assertEqual(
+            ncpaUtil.perfdata_values(perf, limits=True),
+            {'/': 10, '/var': 2, '/var_warn': 6, '/var_crit': 7,
+             '/srv data': 5}
+            )
+
+    def test_long_output_without_perfdata(self):
+        self.assertEqual(
+            ncpaUtil.split_plugin_output('OK | a=1\nline two\nline three'),
+            ('OK', 'line two\nline three', ' a=1')
+            )
+
+
+class TestParseNagios(unittest.TestCase):
+
+    def test_without_perfdata(self):
+        self.assertEqual(
+            ncpaUtil.parse_nagios('CRITICAL - down\nmore detail'),
+            ('CRITICAL - down', Event.Error, {})
+            )
+
+    def test_with_perfdata(self):
+        self.assertEqual(
+            ncpaUtil.parse_nagios("OK - fine | 'a b'=1 c=2.5"),
+            ('OK - fine', Event.Clear, {'a b': 1, 'c': 2.5})
+            )
+
+
+def test_suite():
+    """ Returns the tests for Zenoss's runtests """
+    return unittest.TestSuite([
+        unittest.makeSuite(TestPerfdataValues),
+        unittest.makeSuite(TestSplitPluginOutput),
+        unittest.makeSuite(TestParseNagios),
+        ])
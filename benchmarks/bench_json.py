@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+""" Compares JSON decoders on representative NCPA API responses
+
+Run on a collector, as the zenoss user, with the ZenPack installed:
+    python benchmarks/bench_json.py [--processes 20000] [--repeat 5]
+"""
+
+import argparse
+import json
+import random
+import timeit
+
+from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+
+
+def processes_payload(count):
+    """ api/processes?aggregate=avg from a busy build server """
+    processes = list()
+    for pid in range(1, count + 1):
+        name = random.choice(['java', 'python', 'node', 'bash', 'gcc'])
+        processes.append({
+            'name': name,
+            'pid': pid,
+            'username': 'builder',
+            'exe': '/usr/bin/{0}'.format(name),
+            'cmd': '/usr/bin/{0} {1}'.format(
+                name,
+                ' '.join('--opt{0}=/var/lib/build/{1}'.format(idx, pid)
+                         for idx in range(random.randint(1, 40)))
+                ),
+            'cpu_percent': [round(random.random() * 10, 2), '%'],
+            'mem_percent': [round(random.random(), 2), '%'],
+            'mem_rss': [random.randint(1, 4 * 1024**3), 'B'],
+            'mem_vms': [random.randint(1, 16 * 1024**3), 'B'],
+            })
+    return {'processes': processes}
+
+
+def services_payload(count):
+    """ api/services from a Windows server """
+    return {'services': dict(
+        ('Service{0}'.format(idx), random.choice(['running', 'stopped']))
+        for idx in range(count)
+        )}
+
+
+def root_payload(disks, interfaces, cpus):
+    """ api/ from a host with many disks and interfaces """
+    counters = [[random.randint(0, 10**9) for _ in range(cpus)], 'ms']
+    return {'root': {
+        'cpu': {
+            'count': [cpus, 'cores'],
+            'idle': counters,
+            'percent': [],
+            'system': counters,
+            'user': counters,
+            },
+        'disk': {
+            'logical': dict(
+                ('|mnt|vol{0}'.format(idx), {
+                    'device_name': ['/dev/sd{0}'.format(idx)],
+                    'free': [random.randint(0, 10**12), 'B'],
+                    'fstype': 'xfs',
+                    'opts': 'rw,relatime',
+                    'total': [10**12, 'B'],
+                    'used': [random.randint(0, 10**12), 'B'],
+                    'used_percent': [random.random() * 100, '%'],
+                    })
+                for idx in range(disks)
+                ),
+            'physical': dict(
+                ('sd{0}'.format(idx), dict(
+                    (counter, [random.randint(0, 10**9), unit])
+                    for counter, unit in (
+                        ('read_bytes', 'B'),
+                        ('read_count', 'c'),
+                        ('read_time', 'ms'),
+                        ('write_bytes', 'B'),
+                        ('write_count', 'c'),
+                        ('write_time', 'ms'),
+                        )
+                    ))
+                for idx in range(disks)
+                ),
+            },
+        'interface': dict(
+            ('eth{0}'.format(idx), dict(
+                (counter, [random.randint(0, 10**9), 'B'])
+                for counter in ('bytes_recv', 'bytes_sent', 'dropin',
+                                'dropout', 'errin', 'errout',
+                                'packets_recv', 'packets_sent')
+                ))
+            for idx in range(interfaces)
+            ),
+        'system': {'uptime': [123456.7, 's']},
+        }}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--processes', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(5693)
+    payloads = (
+        ('processes', json.dumps(processes_payload(args.processes))),
+        ('services', json.dumps(services_payload(500))),
+        ('root', json.dumps(root_payload(200, 100, 64))),
+        )
+
+    decoders = list()
+    for name, accelerator in ncpaUtil.json_decoders:
+        try:
+            decoders.append(ncpaUtil.select_json_decoder(name))
+        except ImportError:
+            print('{0}: not installed'.format(name))
+
+    print('{0:<12}{1:>10}{2:>14}{3:>10}'.format(
+        'payload', 'bytes', 'decoder', 'ms'))
+    for payload_name, payload in payloads:
+        baseline = None
+        for name in reversed(decoders):
+            ncpaUtil.select_json_decoder(name)
+            best = min(timeit.repeat(
+                lambda: ncpaUtil.load_json(payload),
+                repeat=args.repeat,
+                number=1
+                )) * 1000
+            baseline = baseline or best
+            print('{0:<12}{1:>10}{2:>14}{3:>10.1f}  x{4:.2f}'.format(
+                payload_name,
+                len(payload),
+                name,
+                best,
+                baseline / best
+                ))
+
+    ncpaUtil.select_json_decoder()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+""" Compares Nagios plugin output parsers on captured plugin output
+
+Run on a collector, as the zenoss user, with the ZenPack installed:
+    python benchmarks/bench_perfdata.py [--number 10000] [--repeat 5]
+"""
+
+import argparse
+import timeit
+
+from Products.ZenEvents import Event
+
+from ZenPacks.daviswr.NCPA.lib import ncpaUtil
+
+
+# Output of common plugins, as returned by api/plugins
+OUTPUTS = (
+    ('no_perfdata', 'OK: Service is running'),
+    ('check_load',
+     'OK - load average: 0.12, 0.20, 0.18|load1=0.120;5.000;10.000;0; '
+     'load5=0.200;4.000;6.000;0; load15=0.180;3.000;4.000;0;'),
+    ('check_disk',
+     'DISK OK - free space: / 3326 MB (56% inode=97%); /boot 68 MB (69% '
+     'inode=99%); /home 69357 MB (26% inode=99%);| /=2643MB;5948;5958;0;'
+     '5968 /boot=28MB;96;101;0;106 /home=197189MB;259931;262411;0;264892'),
+    ('check_http',
+     'HTTP OK: HTTP/1.1 200 OK - 1283 bytes in 0.023 second response time '
+     '|time=0.023425s;1.000000;5.000000;0.000000 size=1283B;;;0'),
+    ('check_nt',
+     "c:\\ - total: 118.91 Gb - used: 41.27 Gb (35%) - free 77.64 Gb "
+     "(65%) | 'c:\\ Used Space'=41.27Gb;95.13;107.02;0.00;118.91"),
+    ('long_output',
+     'MYSQL OK - 4 threads running\n'
+     'Uptime: 1036 Threads: 4 Questions: 2847\n'
+     'Slow queries: 0 Opens: 112 | threads=4;10;20;0;\n'
+     'questions=2847c;;;0; slow_queries=0c;;;0; opens=112c;;;0;'),
+    )
+
+
+def legacy_parse_nagios(stdout):
+    """ The parse_nagios this ZenPack shipped before split_plugin_output """
+    values = dict()
+    state, value_str = stdout.split('|') if '|' in stdout else (stdout, '')
+
+    if 'WARNING' in state.upper():
+        severity = Event.Warning
+    elif 'CRITICAL' in state.upper():
+        severity = Event.Error
+    elif 'OK' not in state.upper():
+        severity = Event.Warning
+    else:
+        severity = Event.Clear
+
+    if value_str:
+        # Make thresholds easy to ignore
+        pairs = value_str.replace(';', ' ').split(' ')
+        for pair in pairs:
+            # Only process actual key-value pairs
+            if '=' in pair:
+                key, value = pair.split('=')
+                # Clean up included units
+                if not value.isdigit():
+                    new_value = ''
+                    for char in value:
+                        if char in '0123456789-.':
+                            new_value += char
+                    value = new_value
+                if value:
+                    values.update({
+                        key: float(value) if '.' in value else int(value)
+                        })
+
+    return state, severity, values
+
+
+def parse_with_limits(stdout):
+    """ parse_nagios, keeping thresholds and limits as datapoint values """
+    state, _, perf = ncpaUtil.split_plugin_output(stdout)
+    return (
+        state,
+        ncpaUtil.nagios_severity(state),
+        ncpaUtil.perfdata_values(perf, limits=True),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    parsers = (
+        ('legacy', legacy_parse_nagios),
+        ('current', ncpaUtil.parse_nagios),
+        ('limits', parse_with_limits),
+        )
+
+    print('{0:<14}{1:>10}{2:>8}{3:>10}'.format(
+        'output', 'parser', 'values', 'us'))
+    for output_name, output in OUTPUTS:
+        baseline = None
+        for name, parse in parsers:
+            try:
+                values = parse(output)[2]
+            except ValueError:
+                # Such as more than one | in long output
+                print('{0:<14}{1:>10}{2:>8}{3:>10}'.format(
+                    output_name, name, '-', 'failed'))
+                continue
+            best = min(timeit.repeat(
+                lambda: parse(output),
+                repeat=args.repeat,
+                number=args.number
+                )) / args.number * 1000000
+            baseline = baseline or best
+            print('{0:<14}{1:>10}{2:>8}{3:>10.2f}  x{4:.2f}'.format(
+                output_name,
+                name,
+                len(values),
+                best,
+                baseline / best
+                ))
+
+
+if __name__ == '__main__':
+    main()